@@ -0,0 +1,213 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+band averages and spectral indices
+
+The band weights of each spectrometer calibration are computed once and
+cached as a (sparse if scipy is available) matrix, so band values for many
+spectra are obtained with a single matrix multiplication::
+
+  bands = [PiccoloBand('red',centre=660,fwhm=30),
+           PiccoloBand('nir',centre=860,fwhm=40)]
+  integrator = PiccoloBandIntegrator(bands)
+  values = integrator.integrate(spectra)
+  ndvi = normalisedDifference(values[:,1],values[:,0])
+"""
+
+__all__ = ['PiccoloBand','PiccoloBandIntegrator','normalisedDifference',
+           'spectrumWavelengths']
+
+import threading
+import numpy
+try:
+    import scipy.sparse
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+class PiccoloBand(object):
+    """a spectral band defined either by its centre and full width at half
+    maximum (gaussian response) or by a tabulated response curve"""
+
+    def __init__(self,name,centre=None,fwhm=None,wavelengths=None,
+                 response=None):
+        """:param name: the name of the band
+           :param centre: the centre wavelength of a gaussian band
+           :param fwhm: the full width at half maximum of a gaussian band
+           :param wavelengths: the wavelengths of a tabulated response
+           :param response: the tabulated response"""
+        self._name = name
+        if centre is not None:
+            if fwhm is None or wavelengths is not None or response is not None:
+                raise ValueError, 'specify either centre and fwhm or a response curve'
+            assert fwhm > 0
+            self._centre = float(centre)
+            self._fwhm = float(fwhm)
+            self._wavelengths = None
+            self._response = None
+        else:
+            if wavelengths is None or response is None:
+                raise ValueError, 'specify either centre and fwhm or a response curve'
+            self._wavelengths = numpy.asarray(wavelengths,dtype=numpy.float64)
+            self._response = numpy.asarray(response,dtype=numpy.float64)
+            if self._wavelengths.shape != self._response.shape:
+                raise ValueError, 'wavelengths and response must have the same shape'
+            order = numpy.argsort(self._wavelengths)
+            self._wavelengths = self._wavelengths[order]
+            self._response = self._response[order]
+            self._centre = None
+            self._fwhm = None
+
+    @property
+    def name(self):
+        """the name of the band"""
+        return self._name
+
+    def response(self,wavelengths):
+        """the relative response of the band at the given wavelengths"""
+        wavelengths = numpy.asarray(wavelengths,dtype=numpy.float64)
+        if self._centre is not None:
+            sigma = self._fwhm/(2*numpy.sqrt(2*numpy.log(2)))
+            x = (wavelengths-self._centre)/sigma
+            r = numpy.exp(-0.5*x*x)
+            # truncate gaussian at 3 sigma to keep the weights sparse
+            r[numpy.abs(x)>3] = 0
+            return r
+        return numpy.interp(wavelengths,self._wavelengths,self._response,
+                            left=0.,right=0.)
+
+    def __repr__(self):
+        if self._centre is not None:
+            return 'PiccoloBand({0!r},centre={1},fwhm={2})'.format(
+                self.name,self._centre,self._fwhm)
+        return 'PiccoloBand({0!r},{1} response values)'.format(
+            self.name,len(self._response))
+
+def spectrumWavelengths(spectrum):
+    """compute the wavelengths of all pixels of a spectrum
+
+    :type spectrum: PiccoloSpectrum"""
+    return spectrum.pixelWavelengths()
+
+class PiccoloBandIntegrator(object):
+    """compute band averages for spectra
+
+    The weight matrices are cached per spectrometer calibration."""
+
+    BATCHSIZE = 256
+
+    def __init__(self,bands):
+        """:param bands: list of PiccoloBand objects"""
+        self._bands = list(bands)
+        assert len(self._bands) > 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @property
+    def bands(self):
+        """the bands"""
+        return self._bands
+
+    @property
+    def names(self):
+        """the names of the bands"""
+        return [b.name for b in self._bands]
+
+    def _key(self,spectrum):
+        n = spectrum.getNumberOfPixels()
+        C = spectrum.get('WavelengthCalibrationCoefficients')
+        if C is not None:
+            C = tuple(C)
+        idx = spectrum.get('Wavelengths')
+        if idx is not None:
+            idx = numpy.asarray(idx,dtype=numpy.float64).tostring()
+        return (spectrum.get('SerialNumber'),C,n,idx)
+
+    def _weights(self,spectrum):
+        """get the cached weight matrix and the bands not covered by the 
+        spectrometer"""
+        key = self._key(spectrum)
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None:
+            return entry
+
+        wavelengths = spectrumWavelengths(spectrum)
+        W = numpy.vstack([b.response(wavelengths) for b in self._bands])
+        total = W.sum(axis=1)
+        uncovered = total == 0
+        total[uncovered] = 1
+        W = W/total[:,None]
+        if HAVE_SCIPY:
+            W = scipy.sparse.csr_matrix(W)
+        entry = (W,uncovered)
+        with self._lock:
+            self._cache[key] = entry
+        return entry
+
+    def weightMatrix(self,spectrum):
+        """the weight matrix for the calibration of a spectrum
+
+        :return: matrix of shape (nBands,nPixels) with rows summing to 1,
+                 rows of bands not covered by the spectrometer are 0;
+                 a scipy.sparse matrix if scipy is available"""
+        return self._weights(spectrum)[0]
+
+    def _integrateBatch(self,spectra,out,offsets):
+        groups = {}
+        for i,s in zip(offsets,spectra):
+            groups.setdefault(self._key(s),[]).append((i,s))
+        for members in groups.itervalues():
+            W,uncovered = self._weights(members[0][1])
+            P = numpy.vstack([s.pixels for i,s in members]).astype(numpy.float64)
+            if HAVE_SCIPY:
+                values = numpy.asarray((W*P.T).T)
+            else:
+                values = numpy.dot(P,W.T)
+            # bands not covered by the spectrometer result in NaN
+            values[:,uncovered] = numpy.nan
+            out[[i for i,s in members]] = values
+
+    def integrate(self,spectra):
+        """compute the band averages
+        :param spectra: a PiccoloSpectraList or any iterable of spectra, eg
+                        from an archive stream; the spectra are processed in
+                        batches of BATCHSIZE
+        :return: array of shape (nSpectra,nBands)"""
+        results = []
+        batch = []
+        for s in spectra:
+            batch.append(s)
+            if len(batch) >= self.BATCHSIZE:
+                out = numpy.empty((len(batch),len(self._bands)))
+                self._integrateBatch(batch,out,range(len(batch)))
+                results.append(out)
+                batch = []
+        if len(batch) > 0 or len(results) == 0:
+            out = numpy.empty((len(batch),len(self._bands)))
+            self._integrateBatch(batch,out,range(len(batch)))
+            results.append(out)
+        return numpy.vstack(results)
+
+def normalisedDifference(a,b):
+    """compute the normalised difference (a-b)/(a+b), eg NDVI with a the
+    near infrared and b the red band"""
+    a = numpy.asarray(a,dtype=numpy.float64)
+    b = numpy.asarray(b,dtype=numpy.float64)
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        return (a-b)/(a+b)
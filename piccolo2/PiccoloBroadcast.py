@@ -0,0 +1,188 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+fan out worker results to several subscribers
+"""
+
+__all__ = ['PiccoloBroadcast','PiccoloSubscriber']
+
+from Queue import Empty, Full
+import threading
+import time
+
+class PiccoloBroadcast(object):
+    """broadcast results to several subscribers
+
+    Results are stored in a bounded ring buffer. Each subscriber has its own
+    cursor and receives every result, the result objects are shared and not
+    copied. The object can be used as the results queue of a
+    PiccoloWorkerThread.
+
+    When a subscriber falls behind by more than the capacity of the buffer
+    the policy decides what happens:
+     * 'drop': the oldest results are dropped for the slow subscriber
+     * 'block': the producer blocks until the slowest subscriber catches up
+    """
+
+    CAPACITY = 64
+
+    def __init__(self,capacity=None,policy='drop'):
+        """:param capacity: the size of the ring buffer, use CAPACITY when
+                            None
+           :param policy: one of 'drop' or 'block'"""
+        if capacity is None:
+            capacity = self.CAPACITY
+        assert capacity > 0
+        if policy not in ['drop','block']:
+            raise ValueError, 'policy must be one of drop or block'
+        self._capacity = capacity
+        self._policy = policy
+        self._buffer = [None]*capacity
+        self._head = 0
+        self._subscribers = []
+        self._cond = threading.Condition(threading.Lock())
+
+    @property
+    def capacity(self):
+        """the size of the ring buffer"""
+        return self._capacity
+
+    @property
+    def policy(self):
+        """the slow subscriber policy"""
+        return self._policy
+
+    def subscribe(self):
+        """create a new subscriber, it receives all results published from
+        now on
+        :rtype: PiccoloSubscriber"""
+        with self._cond:
+            s = PiccoloSubscriber(self,self._head)
+            self._subscribers.append(s)
+        return s
+
+    def unsubscribe(self,subscriber):
+        """remove a subscriber"""
+        with self._cond:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+            self._cond.notify_all()
+
+    def _full(self):
+        # called with lock held
+        if self._policy != 'block' or not self._subscribers:
+            return False
+        oldest = min(s._cursor for s in self._subscribers)
+        return self._head - oldest >= self._capacity
+
+    def put(self,item,block=True,timeout=None):
+        """publish a result
+        :param item: the result
+        :param block: when the policy is 'block' wait for a free slot
+        :param timeout: maximum time to wait, raise Queue.Full on timeout"""
+        with self._cond:
+            if self._full():
+                if not block:
+                    raise Full
+                deadline = None
+                if timeout is not None:
+                    deadline = time.time()+timeout
+                while self._full():
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline-time.time()
+                        if remaining <= 0:
+                            raise Full
+                        self._cond.wait(remaining)
+            self._buffer[self._head % self._capacity] = item
+            self._head += 1
+            self._cond.notify_all()
+
+    def put_nowait(self,item):
+        """publish a result without blocking"""
+        return self.put(item,False)
+
+    def _get(self,subscriber,block,timeout):
+        with self._cond:
+            deadline = None
+            if timeout is not None:
+                deadline = time.time()+timeout
+            while subscriber._cursor >= self._head:
+                if not block:
+                    raise Empty
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline-time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self._cond.wait(remaining)
+            oldest = self._head-self._capacity
+            if subscriber._cursor < oldest:
+                # only happens with the drop policy
+                subscriber._dropped += oldest-subscriber._cursor
+                subscriber._cursor = oldest
+            item = self._buffer[subscriber._cursor % self._capacity]
+            subscriber._cursor += 1
+            if self._policy == 'block':
+                self._cond.notify_all()
+            return item
+
+    def _qsize(self,subscriber):
+        with self._cond:
+            return min(self._head-subscriber._cursor,self._capacity)
+
+class PiccoloSubscriber(object):
+    """a subscriber of a PiccoloBroadcast
+
+    The subscriber provides the reading part of the Queue.Queue interface.
+    """
+
+    def __init__(self,broadcast,cursor):
+        self._broadcast = broadcast
+        self._cursor = cursor
+        self._dropped = 0
+
+    @property
+    def dropped(self):
+        """the number of results dropped because the subscriber was too
+        slow"""
+        return self._dropped
+
+    def get(self,block=True,timeout=None):
+        """get the next result
+        :param block: wait for a result
+        :param timeout: maximum time to wait, raise Queue.Empty on timeout"""
+        return self._broadcast._get(self,block,timeout)
+
+    def get_nowait(self):
+        """get the next result without blocking"""
+        return self.get(False)
+
+    def qsize(self):
+        """the number of results waiting for this subscriber"""
+        return self._broadcast._qsize(self)
+
+    def empty(self):
+        """whether there are no results waiting"""
+        return self.qsize() == 0
+
+    def unsubscribe(self):
+        """stop receiving results"""
+        self._broadcast.unsubscribe(self)
@@ -1,29 +1,73 @@
 import numpy as np
 import base64,zlib
+import json
 import struct
-def compressArray(array,dtype='uint16'):
+from PiccoloProfile import span
+
+# All compress functions take a binary argument. When it is set the zlib
+# compressed bytes are returned without base64 encoding, for channels that
+# can carry bytes. The decompress functions then accept bytes, buffers,
+# bytearrays or memoryviews.
+
+def _pack(byte_data,binary):
+    """zlib compress and, unless binary is set, base64 encode"""
+    compressed_data = zlib.compress(byte_data)
+    if binary:
+        return compressed_data
+    return base64.b64encode(compressed_data)
+
+def _unpack(data,binary):
+    """inverse of _pack"""
+    if binary:
+        # python 2 zlib only accepts strings and read-only buffers
+        if isinstance(data,memoryview):
+            data = data.tobytes()
+        elif isinstance(data,bytearray):
+            data = buffer(data)
+        return zlib.decompress(data)
+    return zlib.decompress(base64.b64decode(data))
+
+def _checkOut(out,shape):
+    """check a caller supplied output array"""
+    if out.shape != shape:
+        raise ValueError, 'output array has shape {0}, expected {1}'.format(
+            out.shape,shape)
+    if not out.flags.c_contiguous:
+        raise ValueError, 'output array must be contiguous'
+
+def compressArray(array,dtype='uint16',binary=False):
     """Converts a numpy array into a byte array, then gzips it and
     base64 encodes it. Should be ~50% smaller than string representation.
     """
-    #only retype array if necessary
-    if array.dtype != dtype:
-        array = array.astype(dtype)
-    byte_data = array.tostring()
-    compressed_data = zlib.compress(byte_data)
-    b64_data = base64.b64encode(compressed_data)
-    return b64_data
+    with span('compressArray') as sp:
+        #only retype array if necessary
+        if array.dtype != dtype:
+            array = array.astype(dtype)
+        byte_data = array.tostring()
+        packed_data = _pack(byte_data,binary)
+        sp.nbytes = len(byte_data)
+    return packed_data
 
 
 
-def decompressArray(b64_data, dtype='uint16'):
-    """Performs inverse operations of compressArray"""
-    compressed_data = base64.b64decode(b64_data)
-    byte_data = zlib.decompress(compressed_data)
-    array = np.fromstring(byte_data,dtype=dtype)
+def decompressArray(b64_data, dtype='uint16', binary=False, out=None):
+    """Performs inverse operations of compressArray
+
+    In binary mode the returned array is a read-only view of the
+    decompressed bytes unless an output array is supplied.
+    :param out: array the data is written to"""
+    byte_data = _unpack(b64_data,binary)
+    array = np.frombuffer(byte_data,dtype=dtype)
+    if out is not None:
+        _checkOut(out,array.shape)
+        out[...] = array
+        return out
+    if not binary:
+        array = array.copy()
     return array
 
 
-def compressAsDiff(array,dtype='uint8',fallback_dtype='uint16'):
+def compressAsDiff(array,dtype='uint8',fallback_dtype='uint16',binary=False):
     """Sometimes a smaller data type can be used if the diff of an array is
     used rather than the array itself.  If the data type can't be made 
     smaller, fall back on the base compression method.
@@ -31,90 +75,364 @@ def compressAsDiff(array,dtype='uint8',fallback_dtype='uint16'):
     """
     diff_arr = np.diff(array)
     if np.max(np.abs(diff_arr)) < np.iinfo(dtype).max:
-        return True,compressArray(diff_arr,dtype)
+        return True,compressArray(diff_arr,dtype,binary=binary)
     else:
-        return False,compressArray(array,fallback_dtype)
+        return False,compressArray(array,fallback_dtype,binary=binary)
 
-def compressFileList(file_list):
+def compressFileList(file_list,binary=False):
     """File lists are highly repetitive, a simple zip works well"""
-    return base64.b64encode(zlib.compress(','.join(file_list)))
+    return _pack(','.join(file_list),binary)
 
 
-def decompressFileList(compressed_files):
-    files = zlib.decompress(base64.b64decode(compressed_files)).split(',')
+def decompressFileList(compressed_files,binary=False):
+    files = _unpack(compressed_files,binary).split(',')
     if files == ['']:
         files.pop()
     return files
 
 
-def compress16to8(array):
-    """scale down from 16 bits to 8 in a not-as-lossy-as-it-could-be way"""
-    min_val = array.min()
-    array -= min_val
+def compress16to8(array,binary=False):
+    """scale down from 16 bits to 8 in a not-as-lossy-as-it-could-be way
+
+    A single scale factor is used for the whole array, the maximum error is
+    (max-min)/255. See compressBlockScaled for a codec with a per block 
+    scale factor and a configurable error bound.
+
+    The minimum is stored as a 16 bit unsigned integer, so the values must
+    not be negative."""
+    array = np.asarray(array,dtype='float32')
+    if array.min() < 0:
+        raise ValueError, 'compress16to8 cannot compress negative values'
+    min_val = int(np.floor(array.min()))
+    if min_val > np.iinfo('uint16').max:
+        raise ValueError, 'compress16to8 minimum value {0} does not fit into 16 bits'.format(min_val)
     #cover the smallest range of values possible, this is kinda slow
-    max_val = array.max()
-    scale_down_factor= 255./max_val
-    array*=scale_down_factor
-    smaller_arr = (array).astype('uint8')
+    max_val = array.max()-min_val
+    if max_val > 0:
+        scale_down_factor= 255./max_val
+    else:
+        scale_down_factor = 1.
+    smaller_arr = ((array-min_val)*scale_down_factor).astype('uint8')
     byte_arr = struct.pack("fH",scale_down_factor,min_val)
     byte_arr += smaller_arr.tostring()
-    return base64.b64encode(zlib.compress(byte_arr))
+    return _pack(byte_arr,binary)
+
+# offsets and steps are stored as float32 (PBS1) or, if float32 cannot
+# resolve the requested error bound, as float64 (PBS2)
+_BLOCK_MAGIC = 'PBS1'
+_BLOCK_MAGIC64 = 'PBS2'
+_BLOCK_FLOAT = {_BLOCK_MAGIC:'<f4', _BLOCK_MAGIC64:'<f8'}
+_BLOCK_HEADER = '<4sIHB'
+BLOCKSIZE = 32
+
+def _isBlockScaled(byte_arr):
+    return byte_arr[:len(_BLOCK_MAGIC)] in _BLOCK_FLOAT
+
+def _quantiseBlocks(blocks,ranges,qmax,ctype,ftype):
+    """quantise blocks using offsets and steps of type ftype
+    :return: offsets,steps,codes,decoded values"""
+    offsets = blocks.min(axis=1).astype(ftype)
+    steps = ((blocks.max(axis=1)-offsets)/qmax).astype(ftype)
+    steps[steps==0] = 1
+    codes = np.rint((blocks-offsets[:,None])/steps[:,None])
+    codes = np.clip(codes,0,qmax).astype(ctype)
+    # decode exactly like _decodeBlockScaled
+    decoded = codes.astype(ftype)*steps[:,None]
+    decoded += offsets[:,None]
+    return offsets,steps,codes,decoded
 
-def decompress8to16(byte_string):
-    """Recover an array compressed by compress16to8. Some loss of precision
-    will occur.
+def compressBlockScaled(array,blockSize=BLOCKSIZE,maxError=None,
+                        relError=None,binary=False):
+    """lossy compression of an array using block floating point
+
+    The array is split into blocks of blockSize values. Each block is
+    stored as an offset (the block minimum), a step size and one 8 bit code
+    per value, ie value = offset + code*step. If the requested error bound
+    cannot be met with 8 bit codes, 16 bit codes are used for the whole
+    array. The maximum absolute error of a value is step/2, ie 
+    (block max - block min)/510 for 8 bit codes, plus float32 rounding.
+    If an error bound is given and float32 offsets and steps cannot meet 
+    it, eg for a small bound on large values, they are stored as float64 
+    and the array is decoded as float64.
+
+    The result can be decoded with decompress8to16.
+
+    :param array: the array to be compressed
+    :param blockSize: the number of values per block
+    :param maxError: maximum absolute error
+    :param relError: maximum error relative to the largest absolute value 
+                     of each block
     """
-    byte_arr = zlib.decompress(base64.b64decode(byte_string))
+    data = np.asarray(array,dtype=np.float64).ravel()
+    n = data.size
+    nBlocks = (n+blockSize-1)//blockSize
+    blocks = np.empty(nBlocks*blockSize,dtype=np.float64)
+    blocks[:n] = data
+    # pad with the last value so padding does not widen the range
+    if n > 0:
+        blocks[n:] = data[-1]
+    blocks = blocks.reshape(nBlocks,blockSize)
+
+    ranges = blocks.max(axis=1)-blocks.min(axis=1)
+
+    # find the number of levels required to satisfy the error bound
+    bits = 8
+    err = None
+    if maxError is not None or relError is not None:
+        err = np.empty(nBlocks)
+        err.fill(np.inf)
+        if maxError is not None:
+            err = np.minimum(err,maxError)
+        if relError is not None:
+            err = np.minimum(err,relError*np.abs(blocks).max(axis=1))
+        with np.errstate(divide='ignore',invalid='ignore'):
+            levels = np.where(ranges>0,np.ceil(ranges/(2*err)),0)
+        if nBlocks > 0 and levels.max() > np.iinfo('uint8').max:
+            bits = 16
+            if levels.max() > np.iinfo('uint16').max:
+                raise RuntimeError, 'cannot satisfy error bound with 16 bit codes'
+    ctype = '<u{0}'.format(bits//8)
+    qmax = np.iinfo(ctype).max
+
+    for magic in [_BLOCK_MAGIC,_BLOCK_MAGIC64]:
+        ftype = _BLOCK_FLOAT[magic]
+        offsets,steps,codes,decoded = _quantiseBlocks(blocks,ranges,qmax,
+                                                      ctype,ftype)
+        if err is None or (np.abs(decoded-blocks) <= err[:,None]).all():
+            break
+    else:
+        raise RuntimeError, 'cannot satisfy error bound with float64 offsets'
+
+    byte_arr = ''.join([struct.pack(_BLOCK_HEADER,magic,n,blockSize,bits),
+                        offsets.tostring(),
+                        steps.tostring(),
+                        codes.tostring()])
+    return _pack(byte_arr,binary)
+
+def _decodeBlockHeader(byte_arr):
+    """unpack header of block scaled data
+    :return: n,blockSize,nBlocks,code type,float type,offsets,steps,codes"""
+    hsize = struct.calcsize(_BLOCK_HEADER)
+    magic,n,blockSize,bits = struct.unpack(_BLOCK_HEADER,byte_arr[:hsize])
+    nBlocks = (n+blockSize-1)//blockSize
+    ctype = '<u{0}'.format(bits//8)
+    ftype = _BLOCK_FLOAT[magic]
+    fsize = np.dtype(ftype).itemsize*nBlocks
+    offsets = np.frombuffer(byte_arr,dtype=ftype,count=nBlocks,offset=hsize)
+    steps = np.frombuffer(byte_arr,dtype=ftype,count=nBlocks,
+                          offset=hsize+fsize)
+    codes = np.frombuffer(byte_arr,dtype=ctype,count=nBlocks*blockSize,
+                          offset=hsize+2*fsize)
+    return n,blockSize,nBlocks,ctype,ftype,offsets,steps,codes
+
+def _decodeBlockScaled(byte_arr,out=None):
+    n,blockSize,nBlocks,ctype,ftype,offsets,steps,codes = \
+        _decodeBlockHeader(byte_arr)
+    if out is None:
+        out = np.empty(n,dtype=np.dtype(ftype).type)
+    else:
+        _checkOut(out,(n,))
+    # decode the complete blocks and the partial last block separately so 
+    # that the padding is never materialised
+    nFull = n//blockSize
+    m = nFull*blockSize
+    if nFull > 0:
+        o = out[:m].reshape(nFull,blockSize)
+        np.multiply(codes[:m].reshape(nFull,blockSize),steps[:nFull,None],
+                    out=o)
+        o += offsets[:nFull,None]
+    if n > m:
+        o = out[m:]
+        np.multiply(codes[m:n],steps[nFull],out=o)
+        o += offsets[nFull]
+    return out
+
+def _decode8to16(byte_arr,out=None):
+    if _isBlockScaled(byte_arr):
+        return _decodeBlockScaled(byte_arr,out=out)
     scale_down_factor,min_val = struct.unpack("fH",byte_arr[:6])
-    array = np.fromstring(byte_arr[6:],dtype='uint8')
-    out_arr = np.zeros(array.size,dtype='float32')+min_val
-    out_arr[:]+=((array.astype('float32'))/scale_down_factor)
-    return out_arr
+    array = np.frombuffer(byte_arr,dtype='uint8',offset=6)
+    if out is None:
+        out = np.empty(array.size,dtype='float32')
+    else:
+        _checkOut(out,array.shape)
+    np.divide(array,np.float32(scale_down_factor),out=out)
+    out += min_val
+    return out
 
-def compressMetadata(spectra_dicts):
+def decompress8to16(byte_string,binary=False,out=None):
+    """Recover an array compressed by compress16to8 or compressBlockScaled.
+    Some loss of precision will occur.
+    :param out: contiguous array the values are written to
+    """
+    return _decode8to16(_unpack(byte_string,binary),out=out)
+
+def decompress8to16Batch(byte_strings,binary=False,out=None):
+    """Recover several arrays compressed by compressBlockScaled.
+
+    Arrays with the same length, block size, code and float type are 
+    decoded together in a single vectorised operation.
+    :param out: 2D array of shape (number of arrays, array length) the 
+                values are written to, each array is decoded directly into 
+                its row
+    :return: 2D array if all arrays have the same length, otherwise list of
+             arrays"""
+    if out is not None:
+        if out.ndim != 2 or out.shape[0] != len(byte_strings):
+            raise ValueError, 'output array must have one row per array'
+        for i,b in enumerate(byte_strings):
+            _decode8to16(_unpack(b,binary),out=out[i])
+        return out
+
+    decoded = [None]*len(byte_strings)
+    groups = {}
+    for i,b in enumerate(byte_strings):
+        byte_arr = _unpack(b,binary)
+        if not _isBlockScaled(byte_arr):
+            # legacy format
+            decoded[i] = _decode8to16(byte_arr)
+            continue
+        header = _decodeBlockHeader(byte_arr)
+        groups.setdefault(header[:5],[]).append((i,header[5:]))
+
+    for (n,blockSize,nBlocks,ctype,ftype),members in groups.iteritems():
+        m = len(members)
+        offsets = np.concatenate([h[0] for i,h in members]).reshape(m,nBlocks)
+        steps = np.concatenate([h[1] for i,h in members]).reshape(m,nBlocks)
+        codes = np.concatenate([h[2] for i,h in members])
+        out_arr = codes.reshape(m,nBlocks,blockSize).astype(ftype)
+        out_arr *= steps[:,:,None]
+        out_arr += offsets[:,:,None]
+        out_arr = out_arr.reshape(m,nBlocks*blockSize)[:,:n]
+        for j,(i,h) in enumerate(members):
+            decoded[i] = out_arr[j]
+
+    if len(decoded) > 0 and len(set(d.size for d in decoded)) == 1:
+        return np.vstack(decoded)
+    return decoded
+
+_METADATA_MAGIC = '!2'
+
+def _indexType(n):
+    """the smallest unsigned integer type that can index n values"""
+    for dtype in ['<u1','<u2','<u4']:
+        if n <= np.iinfo(dtype).max:
+            return dtype
+    return '<u8'
+
+def _hashableValue(value):
+    """turn metadata value into something that can be used as a dict key"""
+    if isinstance(value,(list,dict)):
+        return ('json',json.dumps(value,sort_keys=True))
+    # distinguish between True and 1
+    return (type(value).__name__,value)
+
+def compressMetadata(spectra_dicts,binary=False):
     """Compress a list of dictionaries of metadata into a string.
-    Takes a list of dictionaries with the following keys:
-        'SerialNumber','Dark','Direction','SaturationLevel'
-        'WavelengthCalibrationCoefficients'
-    And returns a string of the format: [SerialNumber 1 ... SerialNumber N] as 
-    plaintext, followed by [WCC 1 SatLvl1 ... WCC N SatLvl N] as base64 strings,
-    followed by the serial number index  of each spectrum('0'-'9'), followed by
-    a list of upwelling-light ('U') vs downwelling-light ('D') vs upwelling-dark
-    ('u') vs downwelling-dark ('d') for each spectrum.
+    Takes a list of spectrum dictionaries and encodes all keys of their
+    'Metadata' dictionary. Each key is stored as a column. Columns are
+    either dictionary encoded, ie a list of the distinct values followed by
+    an index into that list for each spectrum, or, for numeric values that
+    are (mostly) unique, stored as a raw array. The column schema is stored
+    as a JSON header followed by the binary column data. The result is 
+    zlib compressed and base64 encoded.
     """
-    meta_dicts = [s['Metadata'] for s in spectra_dicts]
-    serialNos = list(set([m['SerialNumber'] for m in meta_dicts]))
-
-    #base64 encode WavelengthCalibrationCoefficients and Saturation Levels as 
-    #4-byte numbers
-    waveCalibCoeffs = []
-    satLvls = []
-    for sn in serialNos:
-        #lazy one liner to find a spectrum with the right serial number
-        sn_metas = [m for m in meta_dicts if m['SerialNumber'] == sn]
-        m = sn_metas[0]
-        wcc_bytes = np.array(m['WavelengthCalibrationCoefficients'],dtype='float32')
-        waveCalibCoeffs.append(wcc_bytes.tostring())
-        #SaturationLevel isn't always in there for some reason
-        sat_bytes = np.array(m.get('SaturationLevel',1), dtype='uint32')
-        satLvls.append(sat_bytes.tostring())
-    
-    numeric_mdata = base64.b64encode(''.join(waveCalibCoeffs+satLvls))
-
-    #get the spectrometer order of the set of records
-    sn_order = [str(serialNos.index(m['SerialNumber'])) for m in meta_dicts]
-    
-    #get the direction and light level of each spectrum
-    #this probably isn't very robust
-    dir_light = [(2*m['Direction'][0]).title()[m['Dark']]for m in meta_dicts]
-
-    #concatenate everything and return
-    return ''.join([' '.join(serialNos),' ',numeric_mdata,' ']+sn_order+dir_light)
-
-def decompressMetadata(meta_string):
+    n = len(spectra_dicts)
+    columns = {}
+    # build column dictionaries in a single pass over the metadata
+    for i,s in enumerate(spectra_dicts):
+        for key,value in s['Metadata'].iteritems():
+            if key not in columns:
+                columns[key] = ({},[],[-1]*n)
+            lookup,values,indices = columns[key]
+            h = _hashableValue(value)
+            if h not in lookup:
+                lookup[h] = len(values)
+                values.append(value)
+            indices[i] = lookup[h]
+
+    schema = []
+    arrays = []
+    for key in sorted(columns.keys()):
+        lookup,values,indices = columns[key]
+        # only store values as a raw array if they share a type that 
+        # survives the round trip
+        dtype = None
+        if all(type(v) in (int,long) for v in values):
+            imin,imax = np.iinfo('<i8').min,np.iinfo('<i8').max
+            if all(imin <= v <= imax for v in values):
+                dtype = '<i8'
+        elif all(type(v) is float for v in values):
+            dtype = '<f8'
+        if dtype is not None and -1 not in indices and len(values) > n/2:
+            schema.append({'key':key,'kind':'raw','dtype':dtype})
+            arrays.append(np.array([values[i] for i in indices],dtype=dtype))
+        else:
+            dtype = _indexType(len(values))
+            idx = np.array(indices,dtype=np.int64)
+            # missing values point to one past the last value
+            idx[idx<0] = len(values)
+            schema.append({'key':key,'kind':'dict','dtype':dtype,
+                           'values':values})
+            arrays.append(idx.astype(dtype))
+
+    header = json.dumps({'n':n,'columns':schema})
+    byte_data = ''.join([struct.pack('<I',len(header)),header]+
+                        [a.tostring() for a in arrays])
+    return _METADATA_MAGIC + _pack(byte_data,binary)
+
+def decompressMetadata(meta_string,binary=False):
     """Reconstruct a list of metadata dictionaries that was encoded by
     compressMetadata
     """
+    if isinstance(meta_string,memoryview):
+        meta_string = meta_string.tobytes()
+    elif isinstance(meta_string,bytearray):
+        meta_string = str(meta_string)
+    if not meta_string.startswith(_METADATA_MAGIC):
+        if binary:
+            raise ValueError, 'legacy metadata is not available in binary form'
+        return _decompressLegacyMetadata(meta_string)
+
+    byte_data = _unpack(meta_string[len(_METADATA_MAGIC):],binary)
+    hlen = struct.unpack('<I',byte_data[:4])[0]
+    header = json.loads(byte_data[4:4+hlen])
+    n = header['n']
+    offset = 4+hlen
+
+    missing = object()
+    keys = []
+    columns = []
+    for c in header['columns']:
+        array = np.frombuffer(byte_data,dtype=c['dtype'],count=n,
+                              offset=offset)
+        offset += array.nbytes
+        if c['kind'] == 'raw':
+            column = array.tolist()
+        else:
+            # fill element by element, otherwise numpy would turn lists
+            # of equal length into a 2D array
+            values = np.empty(len(c['values'])+1,dtype=object)
+            for i,v in enumerate(c['values']):
+                values[i] = v
+            values[-1] = missing
+            column = values[array]
+        keys.append(c['key'])
+        columns.append(column)
+
+    out_list = []
+    for row in zip(*columns):
+        meta = dict((k,v) for k,v in zip(keys,row) if v is not missing)
+        out_list.append({"Metadata":meta})
+    if not columns:
+        out_list = [{"Metadata":{}} for i in range(n)]
+    return out_list
+
+def _decompressLegacyMetadata(meta_string):
+    """Reconstruct a list of metadata dictionaries that was encoded by
+    the original version of compressMetadata which only supports up to 10
+    spectrometers with 4 wavelength calibration coefficients each
+    """
     #divide string into sections: Spectrometer names, numeric metadata, and
     #measurement condition metadata
     split_str = meta_string.split(' ')
@@ -133,13 +451,12 @@ def decompressMetadata(meta_string):
     saturationLevels = np.fromstring(saturationBytes,dtype='uint32').tolist()
     coeffList = np.fromstring(coeffBytes,dtype='float32').reshape(nSerialNos,4)
     coeffList = coeffList.tolist()
-    print(coeffList)
 
     #reconstruct the list of dictionaries
     out_list = []
     for spec_num,serial_number_idx in enumerate(spec_used):
         i = int(serial_number_idx)
-        dark = dir_light[i].islower()
+        dark = dir_light[spec_num].islower()
         direction = ["Upwelling","Downwelling"][dir_light[spec_num] in "Dd"]
         out_list.append({
             "Metadata":{
@@ -154,7 +471,6 @@ def decompressMetadata(meta_string):
     return out_list
 
 if __name__ == '__main__':
-    import json
 
     data = np.random.randint(100,2000,100).astype('uint16')
     cdata = compressArray(data)
@@ -187,8 +503,5 @@ if __name__ == '__main__':
     jmeta = json.dumps(meta_list)
     print("Raw json size: {}, Compressed size: {} ({}% of raw)".format(
         len(jmeta),len(cmeta),int((100.*len(cmeta))/len(jmeta))))
-
-
-
-
-
+    assert [m['Metadata'] for m in decompressMetadata(cmeta)] == \
+        [m['Metadata'] for m in meta_list]
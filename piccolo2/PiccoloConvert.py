@@ -0,0 +1,234 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+convert an archive of piccolo spectra files between formats
+
+The supported formats are
+ * 'json': indented JSON as written by PiccoloSpectraList.write
+ * 'compact': JSON without indentation
+ * 'simplified': the compressed M/P/W/D format, see
+   PiccoloSpectraList.compress
+
+Files are converted in parallel using a process pool. Each converted file
+is read back and compared with the original. Converted files are recorded
+in a journal in the output directory so an interrupted conversion can be
+resumed.
+"""
+
+__all__ = ['convertArchive','convertFile','findSpectraFiles','main']
+
+from PiccoloSpectra import PiccoloSpectraList
+import argparse
+import logging
+import multiprocessing
+import os
+import os.path
+import time
+import numpy
+
+FORMATS = ['json','compact','simplified']
+SUFFIXES = ('.pico','.pico.light','.pico.dark')
+JOURNAL = '.piccolo-convert.done'
+
+def findSpectraFiles(root):
+    """find all piccolo spectra files below a directory
+    :param root: the top level directory
+    :return: sorted list of file names relative to root"""
+    files = []
+    for dirpath,dirnames,filenames in os.walk(root):
+        dirnames.sort()
+        for f in filenames:
+            if f.endswith(SUFFIXES):
+                files.append(os.path.relpath(os.path.join(dirpath,f),root))
+    files.sort()
+    return files
+
+def encodeSpectra(spectra,fmt):
+    """encode a spectra list
+    :param spectra: the spectra list
+    :param fmt: the output format, one of FORMATS"""
+    if fmt == 'json':
+        return spectra.serialize()
+    elif fmt == 'compact':
+        return spectra.serialize(pretty=False)
+    elif fmt == 'simplified':
+        return spectra.compress()
+    raise ValueError, 'unknown format {0}'.format(fmt)
+
+def _sameSpectra(a,b):
+    """compare two spectra lists
+
+    The simplified format always stores the detector indices of the pixels
+    in the Wavelengths metadata. They are ignored if the original spectrum
+    has no Wavelengths and they cover all pixels."""
+    if a.seqNr != b.seqNr or len(a) != len(b):
+        return False
+    for sa,sb in zip(a,b):
+        ma = dict(sa.items())
+        mb = dict(sb.items())
+        if 'Wavelengths' not in ma and 'Wavelengths' in mb and \
+           list(mb['Wavelengths']) == range(sa.getNumberOfPixels()):
+            del mb['Wavelengths']
+        if ma != mb:
+            return False
+        if not numpy.array_equal(sa.pixels,sb.pixels):
+            return False
+    return True
+
+def _fsyncDirectory(name):
+    fd = os.open(name,os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def convertFile(inName,outName,fmt,verify=True):
+    """convert a single file
+
+    The output is written to a temporary file which is synced and renamed
+    to the output name, the directory is synced before returning. So once
+    this function returns the converted file is on disk, even when the 
+    input file is replaced in place.
+    :param inName: the input file name
+    :param outName: the output file name
+    :param fmt: the output format, one of FORMATS
+    :param verify: read back converted data and compare with the original
+    :return: tuple of input size and output size in bytes"""
+    with open(inName,'r') as inf:
+        data = inf.read()
+    spectra = PiccoloSpectraList(data=data)
+    out = encodeSpectra(spectra,fmt)
+    if verify and not _sameSpectra(spectra,PiccoloSpectraList(data=out)):
+        raise RuntimeError, 'round trip verification failed for {0}'.format(inName)
+
+    outDir = os.path.dirname(outName)
+    if outDir and not os.path.exists(outDir):
+        try:
+            os.makedirs(outDir)
+        except OSError:
+            # directory created by another process
+            if not os.path.isdir(outDir):
+                raise
+    tmpName = outName+'.tmp'
+    with open(tmpName,'w') as outf:
+        outf.write(out)
+        outf.flush()
+        os.fsync(outf.fileno())
+    os.rename(tmpName,outName)
+    _fsyncDirectory(outDir or os.curdir)
+    return len(data),len(out)
+
+def _convertTask(args):
+    inRoot,outRoot,name,fmt,verify = args
+    try:
+        nIn,nOut = convertFile(os.path.join(inRoot,name),
+                               os.path.join(outRoot,name),fmt,verify=verify)
+        return name,nIn,nOut,None
+    except Exception as e:
+        return name,0,0,str(e)
+
+def convertArchive(inRoot,outRoot,fmt,processes=None,verify=True,
+                   resume=True):
+    """convert all spectra files in an archive
+    :param inRoot: the input directory
+    :param outRoot: the output directory, can be the same as the input
+                   directory to recompress in place
+    :param fmt: the output format, one of FORMATS
+    :param processes: the number of worker processes, use the number of CPUs
+                      when None
+    :param verify: read back converted data and compare with the original
+    :param resume: skip files recorded as converted in the journal
+    :return: dictionary with the conversion statistics"""
+    if fmt not in FORMATS:
+        raise ValueError, 'unknown format {0}'.format(fmt)
+    log = logging.getLogger('piccolo.convert')
+
+    if not os.path.exists(outRoot):
+        os.makedirs(outRoot)
+    journalName = os.path.join(outRoot,JOURNAL)
+    done = set()
+    if resume and os.path.exists(journalName):
+        with open(journalName,'r') as journal:
+            done = set(l.strip() for l in journal if l.strip())
+
+    files = [f for f in findSpectraFiles(inRoot) if f not in done]
+    log.info('converting %d files, %d already done',len(files),len(done))
+
+    stats = {'files':0,'failed':[],'bytesIn':0,'bytesOut':0}
+    tasks = [(inRoot,outRoot,f,fmt,verify) for f in files]
+    t0 = time.time()
+    pool = multiprocessing.Pool(processes=processes)
+    try:
+        with open(journalName,'a') as journal:
+            for name,nIn,nOut,error in pool.imap_unordered(_convertTask,tasks):
+                if error is not None:
+                    log.error('failed to convert %s: %s',name,error)
+                    stats['failed'].append(name)
+                    continue
+                # convertFile has synced the file, only now record it
+                journal.write(name+'\n')
+                journal.flush()
+                stats['files'] += 1
+                stats['bytesIn'] += nIn
+                stats['bytesOut'] += nOut
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    elapsed = time.time()-t0
+    stats['elapsed'] = elapsed
+    stats['filesPerSecond'] = stats['files']/elapsed if elapsed > 0 else 0.
+    stats['bytesSaved'] = stats['bytesIn']-stats['bytesOut']
+    return stats
+
+def main():
+    """command line entry point"""
+    parser = argparse.ArgumentParser(
+        description='convert an archive of piccolo spectra files')
+    parser.add_argument('input',help='input directory')
+    parser.add_argument('output',help='output directory')
+    parser.add_argument('-f','--format',choices=FORMATS,default='simplified',
+                        help='output format, default: %(default)s')
+    parser.add_argument('-p','--processes',type=int,default=None,
+                        help='number of worker processes, default: number of CPUs')
+    parser.add_argument('--no-verify',action='store_true',default=False,
+                        help='do not verify converted files')
+    parser.add_argument('--restart',action='store_true',default=False,
+                        help='ignore the journal and convert all files')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stats = convertArchive(args.input,args.output,args.format,
+                           processes=args.processes,
+                           verify=not args.no_verify,
+                           resume=not args.restart)
+    print '{0} files converted in {1:.1f}s ({2:.1f} files/s), {3} failed'.format(
+        stats['files'],stats['elapsed'],stats['filesPerSecond'],
+        len(stats['failed']))
+    print '{0} bytes read, {1} bytes written, {2} bytes saved'.format(
+        stats['bytesIn'],stats['bytesOut'],stats['bytesSaved'])
+    if stats['failed']:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
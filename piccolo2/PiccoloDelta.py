@@ -0,0 +1,191 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+temporal delta compression of a stream of spectra lists
+
+Consecutive spectra recorded by the same spectrometer in the same direction
+are very similar. The encoder keeps the previous frame for each
+(SerialNumber, Direction, Dark) combination and only transmits the residual
+against it. Every KEYFRAME_INTERVAL frames a full keyframe is sent so that
+a receiver can resynchronise.
+"""
+
+__all__ = ['PiccoloDeltaEncoder','PiccoloDeltaDecoder']
+
+from PiccoloCompress import compressArray,decompressArray
+from PiccoloSpectra import PiccoloSpectraList, PiccoloSpectrum
+import json
+import logging
+import numpy
+
+def _frameKey(meta):
+    return (meta.get('SerialNumber'),meta['Direction'],meta['Dark'])
+
+def _residualType(residual):
+    """find the smallest signed integer type that can hold the residual"""
+    if residual.size == 0:
+        return 'int8'
+    vmax = max(abs(int(residual.min())),abs(int(residual.max())))
+    for dtype in ['int8','int16','int32']:
+        if vmax <= numpy.iinfo(dtype).max:
+            return dtype
+    return 'int64'
+
+class PiccoloDeltaEncoder(object):
+    """encode a stream of spectra lists as residuals against the previous
+    frame of each spectrometer/direction/dark combination"""
+
+    KEYFRAME_INTERVAL = 20
+
+    def __init__(self,keyframeInterval=None):
+        """:param keyframeInterval: number of frames between keyframes, use
+                                    KEYFRAME_INTERVAL when None"""
+        if keyframeInterval is None:
+            keyframeInterval = self.KEYFRAME_INTERVAL
+        assert keyframeInterval > 0
+        self._keyframeInterval = keyframeInterval
+        self._frames = {}
+
+    @property
+    def keyframeInterval(self):
+        """the number of frames between keyframes"""
+        return self._keyframeInterval
+
+    def reset(self):
+        """forget all previous frames, the next frames will be keyframes"""
+        self._frames = {}
+
+    def encodeSpectrum(self,spectrum):
+        """encode a single spectrum
+        :param spectrum: the spectrum to be encoded
+        :type spectrum: PiccoloSpectrum
+        :return: dictionary containing the encoded spectrum"""
+        meta = dict(spectrum.items())
+        key = _frameKey(meta)
+        pixels = numpy.rint(spectrum.pixels).astype(numpy.int64)
+
+        count,previous = self._frames.get(key,(None,None))
+        if count is None or count+1 >= self.keyframeInterval or \
+           previous.size != pixels.size:
+            count = 0
+            frameType = 'K'
+            data = pixels
+        else:
+            count += 1
+            frameType = 'R'
+            data = pixels-previous
+        self._frames[key] = (count,pixels)
+
+        dtype = _residualType(data)
+        return {'Metadata':meta, 'T':frameType, 'N':count, 'dtype':dtype,
+                'Pixels':compressArray(data,dtype=dtype)}
+
+    def encode(self,spectra):
+        """encode a spectra list
+        :param spectra: the spectra to be encoded
+        :type spectra: PiccoloSpectraList
+        :return: JSON string"""
+        encoded = [self.encodeSpectrum(s) for s in spectra]
+        return json.dumps({'SequenceNumber':spectra.seqNr,'Delta':encoded})
+
+class PiccoloDeltaDecoder(object):
+    """decode a stream produced by PiccoloDeltaEncoder"""
+
+    def __init__(self):
+        self._frames = {}
+        self._skipped = []
+        self._log = logging.getLogger('piccolo.delta')
+
+    def reset(self):
+        """forget all previous frames, wait for the next keyframes"""
+        self._frames = {}
+
+    @property
+    def skipped(self):
+        """the keys of the spectra skipped by the last call to decode because
+        their reference frame was missing"""
+        return self._skipped
+
+    def decodeSpectrum(self,data):
+        """decode a single spectrum
+        :param data: dictionary produced by PiccoloDeltaEncoder.encodeSpectrum
+        :return: the decoded spectrum
+        :rtype: PiccoloSpectrum"""
+        meta = data['Metadata']
+        key = _frameKey(meta)
+        pixels = decompressArray(data['Pixels'],dtype=data['dtype'])
+        pixels = pixels.astype(numpy.int64)
+
+        if data['T'] == 'R':
+            count,previous = self._frames.get(key,(None,None))
+            if count is None or count+1 != data['N']:
+                # we have missed a frame, drop the reference and wait for
+                # the next keyframe
+                self._frames.pop(key,None)
+                raise RuntimeError, 'missing reference frame for {0}, waiting for keyframe'.format(key)
+            pixels += previous
+        self._frames[key] = (data['N'],pixels)
+
+        return PiccoloSpectrum(data={'Metadata':meta,'Pixels':pixels})
+
+    def decode(self,data):
+        """decode a spectra list
+
+        Spectra whose reference frame is missing are skipped, their keys
+        are available from the skipped property. All other spectra are
+        decoded and their references are updated.
+        :param data: JSON string produced by PiccoloDeltaEncoder.encode
+        :return: the decoded spectra
+        :rtype: PiccoloSpectraList"""
+        if isinstance(data,(str,unicode)):
+            data = json.loads(data)
+        spectra = PiccoloSpectraList(seqNr=data['SequenceNumber'])
+        skipped = []
+        for s in data['Delta']:
+            try:
+                spectra.append(self.decodeSpectrum(s))
+            except RuntimeError as e:
+                self._log.warning(str(e))
+                skipped.append(_frameKey(s['Metadata']))
+        self._skipped = skipped
+        return spectra
+
+if __name__ == '__main__':
+    encoder = PiccoloDeltaEncoder()
+    decoder = PiccoloDeltaDecoder()
+
+    base = numpy.random.randint(100,20000,1024)
+    nFull = 0
+    nDelta = 0
+    for i in range(50):
+        spectra = PiccoloSpectraList(seqNr=i)
+        for d in ['Upwelling','Downwelling']:
+            s = PiccoloSpectrum()
+            s['SerialNumber'] = 'Foo'
+            s.setUpwelling(d=='Upwelling')
+            s.setLight()
+            s.pixels = base + numpy.random.randint(-5,5,base.size)
+            spectra.append(s)
+        enc = encoder.encode(spectra)
+        dec = decoder.decode(enc)
+        for j in range(len(spectra)):
+            assert (dec[j].pixels == spectra[j].pixels).all()
+        nFull += len(spectra.serialize(pretty=False))
+        nDelta += len(enc)
+    print("Full json size: {}, Delta size: {} ({}% of full)".format(
+        nFull,nDelta,int((100.*nDelta)/nFull)))
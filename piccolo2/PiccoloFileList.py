@@ -0,0 +1,248 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+front coded list of file names
+
+The names are grouped into blocks of BLOCKSIZE entries. Within a block
+each name is stored as the length of the prefix it shares with the
+previous name followed by the remaining suffix. The first name of each
+block is kept in an index so that the i-th name is found by decoding a
+single block and sorted lists can be searched by prefix using a binary
+search over the block index. New names are appended to an open tail block.
+"""
+
+__all__ = ['PiccoloFileList']
+
+import base64
+import bisect
+import zlib
+
+MAGIC = 'PFL1'
+
+def _encodeVarint(n):
+    out = []
+    while n >= 0x80:
+        out.append(chr((n&0x7f)|0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _decodeVarint(data,pos):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(data[pos])
+        pos += 1
+        n |= (b&0x7f) << shift
+        if b < 0x80:
+            return n,pos
+        shift += 7
+
+def _sharedPrefix(a,b):
+    n = min(len(a),len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+def _encodeBlock(names):
+    out = []
+    prev = ''
+    for name in names:
+        shared = _sharedPrefix(prev,name)
+        suffix = name[shared:]
+        out.append(_encodeVarint(shared))
+        out.append(_encodeVarint(len(suffix)))
+        out.append(suffix)
+        prev = name
+    return ''.join(out)
+
+def _decodeBlock(block,count=None):
+    names = []
+    prev = ''
+    pos = 0
+    while pos < len(block):
+        if count is not None and len(names) >= count:
+            break
+        shared,pos = _decodeVarint(block,pos)
+        n,pos = _decodeVarint(block,pos)
+        prev = prev[:shared]+block[pos:pos+n]
+        pos += n
+        names.append(prev)
+    return names
+
+class PiccoloFileList(object):
+    """a compact list of file names with random access"""
+
+    BLOCKSIZE = 16
+
+    def __init__(self,names=None,blocksize=None):
+        """:param names: iterable of file names
+           :param blocksize: the number of names per block, use BLOCKSIZE
+                             when None"""
+        if blocksize is not None:
+            assert blocksize > 0
+            self.BLOCKSIZE = blocksize
+        self._blocks = []
+        self._index = []
+        self._tail = []
+        self._sorted = True
+        self._last = None
+        self._cached = (None,None)
+        if names is not None:
+            for n in names:
+                self.append(n)
+
+    def __len__(self):
+        return len(self._blocks)*self.BLOCKSIZE + len(self._tail)
+
+    @property
+    def isSorted(self):
+        """whether the names were appended in sorted order"""
+        return self._sorted
+
+    def append(self,name):
+        """append a file name
+        :param name: the file name, unicode names are stored UTF-8 encoded"""
+        if isinstance(name,unicode):
+            name = name.encode('utf-8')
+        if self._last is not None and name < self._last:
+            self._sorted = False
+        self._last = name
+        self._tail.append(name)
+        if len(self._tail) == self.BLOCKSIZE:
+            self._index.append(self._tail[0])
+            self._blocks.append(_encodeBlock(self._tail))
+            self._tail = []
+
+    def extend(self,names):
+        """append file names"""
+        for n in names:
+            self.append(n)
+
+    def _block(self,b):
+        """get the decoded names of block b"""
+        if b == len(self._blocks):
+            return self._tail
+        if self._cached[0] != b:
+            self._cached = (b,_decodeBlock(self._blocks[b]))
+        return self._cached[1]
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError, 'file list index out of range'
+        b,k = divmod(i,self.BLOCKSIZE)
+        if b == len(self._blocks):
+            return self._tail[k]
+        if self._cached[0] == b:
+            return self._cached[1][k]
+        return _decodeBlock(self._blocks[b],count=k+1)[k]
+
+    def __iter__(self):
+        for b in range(len(self._blocks)):
+            for name in _decodeBlock(self._blocks[b]):
+                yield name
+        for name in list(self._tail):
+            yield name
+
+    def __contains__(self,name):
+        if isinstance(name,unicode):
+            name = name.encode('utf-8')
+        for n in self.startswith(name):
+            if n == name:
+                return True
+        return False
+
+    def startswith(self,prefix):
+        """iterate over all names starting with prefix
+
+        For sorted lists only the blocks that can contain the prefix are
+        decoded.
+        :param prefix: the prefix"""
+        if isinstance(prefix,unicode):
+            prefix = prefix.encode('utf-8')
+        if not self._sorted:
+            for n in self:
+                if n.startswith(prefix):
+                    yield n
+            return
+        index = list(self._index)
+        if len(self._tail) > 0:
+            index.append(self._tail[0])
+        b = max(bisect.bisect_left(index,prefix)-1,0)
+        while b < len(index):
+            for n in self._block(b):
+                if n.startswith(prefix):
+                    yield n
+                elif n > prefix:
+                    return
+            b += 1
+
+    def encode(self):
+        """encode the file list as a base64 encoded, zlib compressed string"""
+        blocks = list(self._blocks)
+        if len(self._tail) > 0:
+            blocks.append(_encodeBlock(self._tail))
+        out = [MAGIC,
+               _encodeVarint(len(self)),
+               _encodeVarint(self.BLOCKSIZE),
+               chr(int(self._sorted))]
+        for block in blocks:
+            out.append(_encodeVarint(len(block)))
+            out.append(block)
+        return base64.b64encode(zlib.compress(''.join(out)))
+
+    @classmethod
+    def decode(cls,data):
+        """create a file list from a string produced by encode
+        :param data: the encoded file list"""
+        raw = zlib.decompress(base64.b64decode(data))
+        if raw[:len(MAGIC)] != MAGIC:
+            raise ValueError, 'not an encoded file list'
+        pos = len(MAGIC)
+        count,pos = _decodeVarint(raw,pos)
+        blocksize,pos = _decodeVarint(raw,pos)
+        isSorted = bool(ord(raw[pos]))
+        pos += 1
+
+        fl = cls(blocksize=blocksize)
+        nFull = count // blocksize
+        for b in range(nFull):
+            n,pos = _decodeVarint(raw,pos)
+            block = raw[pos:pos+n]
+            pos += n
+            fl._blocks.append(block)
+            fl._index.append(_decodeBlock(block,count=1)[0])
+        if count > nFull*blocksize:
+            n,pos = _decodeVarint(raw,pos)
+            fl._tail = _decodeBlock(raw[pos:pos+n])
+            pos += n
+        if len(fl) != count:
+            raise ValueError, 'corrupt file list'
+        fl._sorted = isSorted
+        if count > 0:
+            fl._last = fl[count-1]
+        return fl
+
+    def __repr__(self):
+        return 'PiccoloFileList({0} names)'.format(len(self))
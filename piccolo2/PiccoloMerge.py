@@ -0,0 +1,89 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+time ordered merge of spectra from several instruments and files
+"""
+
+__all__ = ['datetimeToEpoch','mergeSpectra']
+
+from PiccoloSpectra import PiccoloSpectraList
+from datetime import datetime
+import calendar
+import heapq
+
+def datetimeToEpoch(dt):
+    """convert a Datetime string as stored in the spectrum metadata to
+    seconds since the epoch
+    :param dt: the date and time, eg 2016-09-07T12:30:01.123456Z"""
+    dt = dt.rstrip('Z')
+    if '.' in dt:
+        ts = datetime.strptime(dt,'%Y-%m-%dT%H:%M:%S.%f')
+    else:
+        ts = datetime.strptime(dt,'%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(ts.timetuple()) + ts.microsecond*1e-6
+
+def _loadFile(fname):
+    with open(fname,'r') as inf:
+        return PiccoloSpectraList(data=inf.read())
+
+def _iterSource(source):
+    """iterate over the spectra of a source in time order
+
+    Each file or spectra list is sorted by time. Lists of files are read one
+    file at a time and are expected to be in time order."""
+    if isinstance(source,basestring):
+        source = [source]
+    elif isinstance(source,PiccoloSpectraList):
+        source = [source]
+    for item in source:
+        if isinstance(item,basestring):
+            item = _loadFile(item)
+        if isinstance(item,PiccoloSpectraList):
+            spectra = [(datetimeToEpoch(s['Datetime']),s) for s in item]
+            spectra.sort(key=lambda x: x[0])
+            for entry in spectra:
+                yield entry
+        else:
+            # a single spectrum
+            yield datetimeToEpoch(item['Datetime']),item
+
+def mergeSpectra(*sources):
+    """merge spectra from several sources in time order
+
+    A source can be a file name, a PiccoloSpectraList, a sequence of file
+    names and/or spectra lists (eg all files of one instrument in time
+    order) or any iterable of spectra in time order. Only the current file
+    of each source is held in memory.
+
+    :return: generator yielding tuples of (epoch, source index, spectrum)"""
+    iters = [_iterSource(s) for s in sources]
+    heap = []
+    for i,it in enumerate(iters):
+        for epoch,spectrum in it:
+            heap.append((epoch,i,spectrum))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        epoch,i,spectrum = heap[0]
+        yield epoch,i,spectrum
+        for nEpoch,nSpectrum in iters[i]:
+            heapq.heapreplace(heap,(nEpoch,i,nSpectrum))
+            break
+        else:
+            heapq.heappop(heap)
@@ -0,0 +1,219 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+chain worker threads into a pipeline, eg acquire -> compress -> write
+
+Each stage runs one or more PiccoloPipelineWorker threads. Stages are
+connected by bounded queues so that writing batch N overlaps with the
+acquisition of batch N+1 while a slow stage applies back pressure::
+
+  pipeline = PiccoloPipeline(maxsize=4)
+  pipeline.addStage('acquire',acquire)
+  pipeline.addStage('serialize',lambda s: (s,s.serialize()),workers=2)
+  pipeline.addStage('write',write)
+  pipeline.start()
+  for i in range(10):
+      pipeline.put(i)
+  pipeline.close()
+  print pipeline.bottleneck
+"""
+
+__all__ = ['PiccoloPipeline','PiccoloPipelineWorker','PiccoloStageStats']
+
+from PiccoloWorkerThread import PiccoloWorkerThread
+from Queue import Queue
+import threading
+import time
+
+_STOP = object()
+
+class PiccoloStageStats(object):
+    """throughput statistics of a pipeline stage"""
+
+    def __init__(self,name,workers):
+        self._lock = threading.Lock()
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.errors = 0
+        self.busyTime = 0.
+        self.start = None
+        self.end = None
+
+    def record(self,duration,error=False):
+        with self._lock:
+            self.items += 1
+            self.busyTime += duration
+            if error:
+                self.errors += 1
+
+    @property
+    def elapsed(self):
+        """the wall clock time the stage has been running"""
+        if self.start is None:
+            return 0.
+        end = self.end
+        if end is None:
+            end = time.time()
+        return end-self.start
+
+    @property
+    def throughput(self):
+        """items processed per second"""
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.
+        return self.items/elapsed
+
+    @property
+    def utilisation(self):
+        """fraction of time the workers of the stage were busy"""
+        elapsed = self.elapsed
+        if elapsed <= 0:
+            return 0.
+        return self.busyTime/(elapsed*self.workers)
+
+    def __repr__(self):
+        return '{0}: {1} items, {2:.2f} items/s, {3:.0f}% busy, {4} errors'.format(
+            self.name,self.items,self.throughput,100*self.utilisation,
+            self.errors)
+
+class PiccoloPipelineWorker(PiccoloWorkerThread):
+    """worker thread applying the function of a stage to each task"""
+
+    LOGNAME = 'pipeline'
+
+    def __init__(self,name,busy,tasks,results,func,stats,daemon=True):
+        """
+        :param func: the function applied to each task, the return value is
+                     passed to the results queue unless it is None
+        :param stats: the statistics of the stage
+        :type stats: PiccoloStageStats
+        """
+        PiccoloWorkerThread.__init__(self,name,busy,tasks,results,
+                                     daemon=daemon)
+        self._func = func
+        self._stats = stats
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is _STOP:
+                self.tasks.task_done()
+                break
+            error = False
+            result = None
+            with self.busy:
+                t0 = time.time()
+                try:
+                    result = self._func(task)
+                except Exception:
+                    self.log.exception('failed to process task')
+                    error = True
+                duration = time.time()-t0
+            self._stats.record(duration,error=error)
+            if result is not None:
+                self.results.put(result)
+            self.tasks.task_done()
+
+class PiccoloPipeline(object):
+    """a chain of stages connected by bounded queues"""
+
+    def __init__(self,maxsize=4,results=None):
+        """:param maxsize: the size of the queues between stages
+           :param results: the queue receiving the output of the last stage,
+                           create an unbounded queue when None"""
+        self._maxsize = maxsize
+        if results is None:
+            results = Queue()
+        self._results = results
+        self._stages = []
+        self._started = False
+
+    @property
+    def results(self):
+        """the queue receiving the output of the last stage"""
+        return self._results
+
+    def addStage(self,name,func,workers=1,maxsize=None):
+        """append a stage to the pipeline
+        :param name: the name of the stage
+        :param func: function applied to each item, the return value is
+                     passed to the next stage; None results are dropped
+        :param workers: the number of worker threads of the stage
+        :param maxsize: size of the queue feeding the stage, use the
+                        pipeline default when None"""
+        if self._started:
+            raise RuntimeError, 'cannot add stage to running pipeline'
+        assert workers > 0
+        if maxsize is None:
+            maxsize = self._maxsize
+        self._stages.append({'name':name,'func':func,'workers':workers,
+                             'queue':Queue(maxsize=maxsize),
+                             'stats':PiccoloStageStats(name,workers),
+                             'threads':[]})
+
+    def start(self):
+        """start the worker threads of all stages"""
+        if self._started:
+            raise RuntimeError, 'pipeline already started'
+        if len(self._stages) == 0:
+            raise RuntimeError, 'pipeline has no stages'
+        for i,stage in enumerate(self._stages):
+            if i+1 < len(self._stages):
+                out = self._stages[i+1]['queue']
+            else:
+                out = self._results
+            stage['stats'].start = time.time()
+            for j in range(stage['workers']):
+                w = PiccoloPipelineWorker('{0}{1}'.format(stage['name'],j),
+                                          threading.Lock(),stage['queue'],out,
+                                          stage['func'],stage['stats'])
+                stage['threads'].append(w)
+                w.start()
+        self._started = True
+
+    def put(self,item,block=True,timeout=None):
+        """feed an item to the first stage"""
+        if not self._started:
+            raise RuntimeError, 'pipeline not started'
+        self._stages[0]['queue'].put(item,block,timeout)
+
+    def close(self):
+        """process all pending items and stop the worker threads"""
+        if not self._started:
+            return
+        for stage in self._stages:
+            for w in stage['threads']:
+                stage['queue'].put(_STOP)
+            for w in stage['threads']:
+                w.join()
+            stage['stats'].end = time.time()
+        self._started = False
+
+    @property
+    def stats(self):
+        """list of statistics, one per stage"""
+        return [stage['stats'] for stage in self._stages]
+
+    @property
+    def bottleneck(self):
+        """the statistics of the stage with the highest utilisation"""
+        if len(self._stages) == 0:
+            return None
+        return max(self.stats,key=lambda s: s.utilisation)
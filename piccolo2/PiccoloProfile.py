@@ -0,0 +1,166 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+lightweight timing spans for the piccolo hot paths
+
+Profiling is disabled by default. When disabled, span returns a shared
+no-op object so the cost is a function call and an attribute lookup.
+Enable profiling by registering a sink::
+
+  from piccolo2.PiccoloProfile import enableProfiling, PiccoloAggregateSink
+  sink = PiccoloAggregateSink()
+  enableProfiling(sink)
+  ...
+  print sink.report()
+"""
+
+__all__ = ['span','enableProfiling','disableProfiling','profilingEnabled',
+           'PiccoloLoggingSink','PiccoloAggregateSink','PiccoloFileSink']
+
+import logging
+import threading
+import time
+
+_sink = None
+
+class _NullSpan(object):
+    """span used when profiling is disabled"""
+    __slots__ = ()
+    nbytes = 0
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        return False
+    def __setattr__(self,name,value):
+        # ignore byte counts when profiling is disabled
+        pass
+
+_NULLSPAN = _NullSpan()
+
+class _Span(object):
+    """a timed span reporting to a sink"""
+    __slots__ = ('name','nbytes','_sink','_start')
+
+    def __init__(self,sink,name,nbytes):
+        self._sink = sink
+        self.name = name
+        self.nbytes = nbytes
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self,*args):
+        self._sink.record(self.name,time.time()-self._start,self.nbytes)
+        return False
+
+def span(name,nbytes=0):
+    """create a timing span to be used in a with statement
+
+    The number of bytes processed can be set on the span object inside the
+    with block if it is not known beforehand.
+
+    :param name: the name of the span
+    :param nbytes: the number of bytes processed"""
+    sink = _sink
+    if sink is None:
+        return _NULLSPAN
+    return _Span(sink,name,nbytes)
+
+def enableProfiling(sink):
+    """enable profiling
+    :param sink: object with a record(name,duration,nbytes) method"""
+    global _sink
+    _sink = sink
+
+def disableProfiling():
+    """disable profiling"""
+    global _sink
+    _sink = None
+
+def profilingEnabled():
+    """whether profiling is enabled"""
+    return _sink is not None
+
+class PiccoloLoggingSink(object):
+    """sink writing each span to a log"""
+
+    def __init__(self,level=logging.DEBUG):
+        """:param level: the log level"""
+        self._log = logging.getLogger('piccolo.profile')
+        self._level = level
+
+    def record(self,name,duration,nbytes):
+        self._log.log(self._level,'%s: %.6fs %d bytes',name,duration,nbytes)
+
+class PiccoloAggregateSink(object):
+    """sink aggregating call counts, cumulative time and bytes per span"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self,name,duration,nbytes):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = [1,duration,nbytes]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] += nbytes
+
+    @property
+    def stats(self):
+        """dictionary mapping span names to (calls, time, bytes)"""
+        with self._lock:
+            return dict((k,tuple(v)) for k,v in self._stats.iteritems())
+
+    def reset(self):
+        """clear the aggregated statistics"""
+        with self._lock:
+            self._stats = {}
+
+    def report(self):
+        """a table of the aggregated statistics sorted by cumulative time"""
+        lines = ['{0:<30} {1:>8} {2:>12} {3:>14}'.format(
+            'span','calls','time [s]','bytes')]
+        stats = sorted(self.stats.items(),key=lambda x: x[1][1],reverse=True)
+        for name,(calls,duration,nbytes) in stats:
+            lines.append('{0:<30} {1:>8d} {2:>12.6f} {3:>14d}'.format(
+                name,calls,duration,nbytes))
+        return '\n'.join(lines)
+
+class PiccoloFileSink(object):
+    """sink appending each span to a tab separated file"""
+
+    def __init__(self,fname):
+        """:param fname: the name of the output file"""
+        self._lock = threading.Lock()
+        self._out = open(fname,'a')
+
+    def record(self,name,duration,nbytes):
+        with self._lock:
+            self._out.write('{0:.6f}\t{1}\t{2:.6f}\t{3}\n'.format(
+                time.time(),name,duration,nbytes))
+
+    def close(self):
+        """close the output file"""
+        with self._lock:
+            self._out.close()
@@ -22,59 +22,290 @@
 
 __all__ = ['PiccoloSpectraList','PiccoloSpectrum']
 
-from collections import MutableMapping, MutableSequence
+from collections import MutableMapping, MutableSequence, deque
 from datetime import datetime
 from PiccoloCompress import decompressArray,decompress8to16,decompressMetadata
+from PiccoloCompress import compressArray,compressAsDiff,compressBlockScaled
+from PiccoloCompress import compressMetadata
+from PiccoloProfile import span
+import array
+import itertools
 import json
+import mmap
 import os.path
+import tempfile
+import threading
+import weakref
 import numpy
 
 protectedKeys = ['Direction','Dark','Datetime']
 
+# marks pixels of the simplified format stored losslessly, followed by the
+# dtype and another marker
+_LOSSLESS_MAGIC = '!'
+
+def _wavelengthRanges(wavelengths):
+    """turn a wavelength range or list of ranges into a tuple of ranges"""
+    if wavelengths is None:
+        return None
+    if len(wavelengths) == 2 and not hasattr(wavelengths[0],'__len__'):
+        wavelengths = [wavelengths]
+    ranges = []
+    for w in wavelengths:
+        assert len(w) == 2
+        ranges.append((float(min(w)),float(max(w))))
+    return tuple(ranges)
+
 class PiccoloSpectraList(MutableSequence):
     """a collection of spectra
 
     The object behaves like a python list. The object supports chunking which
     can be used to transfer data across a slow network.
+
+    The memory used by the pixel arrays can be limited by setting a memory
+    budget. When the budget is exceeded the pixels of the oldest spectra are
+    spilled to a temporary memory mapped file.
+
+    Spectra can be appended concurrently from several threads. Each thread
+    appends to its own buffer, the buffers are merged into the list when it
+    is read or when the spectra appended since the last merge exceed the 
+    memory budget. Iterating, serialising or chunking the list works on an
+    immutable copy of the list, taken at most once after each change, so
+    producers can keep appending.
     """
 
     _NCHUNKS = 1 #300
+    MEMORY_BUDGET = None
 
-    def __init__(self,seqNr=0,data=None):
+    def __init__(self,seqNr=0,data=None,memoryBudget=None):
         """:param seqNr: the sequence number of the spectra collection;
                          used for constructing the output file name
            :param data:  string containing JSON serialised version of the
                          spectra list. This can be used to create a
                          SpectraList from JSON
+           :param memoryBudget: maximum number of bytes of pixel data held
+                         in memory, use MEMORY_BUDGET when None
         """
-        self._spectra = []
+        self._data = []
+        self._frozen = None
+        self._initThreading()
         self._seqNr = seqNr
         self._prefix = ''
         self._chunkID = None
+        if memoryBudget is None:
+            memoryBudget = self.MEMORY_BUDGET
+        self._memoryBudget = memoryBudget
+        self._nbytes = 0
+        self._firstUnspilled = 0
+        self._spillFile = None
+        self._saturationCache = None
+        self._block = None
 
         # initialise from json if available
         if data is not None:
             self._initFromData(data)
 
+    def _initThreading(self):
+        """create the lock and the per thread append buffers"""
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._buffers = []
+        self._counter = itertools.count()
+        self._pending = 0
+
+    def __getstate__(self):
+        self._merge()
+        state = self.__dict__.copy()
+        # locks, thread local buffers, the spill file and weak references
+        # cannot be pickled, they are recreated when the list is loaded
+        for k in ['_lock','_local','_buffers','_counter','_pending',
+                  '_frozen','_spillFile','_block','_saturationCache']:
+            del state[k]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._initThreading()
+        self._frozen = None
+        self._spillFile = None
+        self._block = None
+        self._saturationCache = None
+        with self._lock:
+            self._recount()
+        self._enforceBudget()
+
     def __getitem__(self,i):
-        return self._spectra[i]
+        self._merge()
+        return self._data[i]
     def __setitem__(self,i,y):
         assert isinstance(y,PiccoloSpectrum)
-        self._spectra[i] = y
+        self._merge()
+        with self._lock:
+            self._data[i] = y
+            self._frozen = None
+            self._block = None
+            self._recount()
+        self._enforceBudget()
     def __delitem__(self,i):
         raise RuntimeError, 'cannot delete spectra'
     def __len__(self):
-        return len(self._spectra)
+        self._merge()
+        return len(self._data)
+    def __iter__(self):
+        return iter(self._items())
     def insert(self,i,y):
         """insert a new Spectrum
         :param i: position in the list after which the new spectrum should be inserted
         :param y: the spectrum object to be inserted
         :type y: PiccoloSpectrum"""
         assert isinstance(y,PiccoloSpectrum)
-        self._spectra.insert(i,y)
+        self._merge()
+        with self._lock:
+            self._data.insert(i,y)
+            self._frozen = None
+            self._block = None
+            self._recount()
+        self._enforceBudget()
+    def append(self,y):
+        """append a new Spectrum
+
+        The spectrum is added to a buffer of the calling thread without
+        locking. It becomes visible when the list is next read. If a memory
+        budget is set and the spectra appended since the last merge exceed
+        it, the buffers are merged so that the budget is enforced.
+        :param y: the spectrum object to be appended
+        :type y: PiccoloSpectrum"""
+        assert isinstance(y,PiccoloSpectrum)
+        buf = getattr(self._local,'buffer',None)
+        if buf is None:
+            buf = deque()
+            self._local.buffer = buf
+            with self._lock:
+                self._buffers.append((threading.current_thread(),buf))
+        buf.append((next(self._counter),y))
+        if self._memoryBudget is not None:
+            # approximate, the counter is not updated atomically
+            self._pending += y.nbytes
+            if self._nbytes+self._pending > self._memoryBudget:
+                self._merge()
+
+    def _merge(self):
+        """move spectra appended by the threads into the list"""
+        if not any(buf for t,buf in self._buffers):
+            return
+        with self._lock:
+            pending = []
+            for t,buf in self._buffers:
+                while buf:
+                    pending.append(buf.popleft())
+            # forget the buffers of threads that have finished
+            self._buffers = [(t,buf) for t,buf in self._buffers 
+                             if t.is_alive() or buf]
+            self._pending = 0
+            if not pending:
+                return
+            pending.sort(key=lambda x: x[0])
+            self._data.extend(y for n,y in pending)
+            self._frozen = None
+            self._nbytes += sum(y.nbytes for n,y in pending)
+        self._enforceBudget()
+
+    def _items(self):
+        """an immutable sequence of the spectra
+
+        The sequence is only copied from the list when the list has changed
+        since the last call."""
+        self._merge()
+        with self._lock:
+            if self._frozen is None:
+                self._frozen = tuple(self._data)
+            return self._frozen
+
+    def snapshot(self):
+        """create a snapshot of the spectra list
+
+        The snapshot shares the spectra with the original list but is not
+        affected by spectra added to the original list later on.
+        :rtype: PiccoloSpectraList"""
+        spectra = PiccoloSpectraList(seqNr=self._seqNr,
+                                     memoryBudget=self._memoryBudget)
+        items = self._items()
+        spectra._data = list(items)
+        spectra._frozen = items
+        spectra._prefix = self._prefix
+        spectra._chunkID = self._chunkID
+        spectra._spillFile = self._spillFile
+        spectra._nbytes = self._nbytes
+        spectra._firstUnspilled = self._firstUnspilled
+        return spectra
+
+    @property
+    def nbytes(self):
+        """the number of bytes of pixel data and cached representations held
+        in memory"""
+        return sum(s.nbytes for s in self._items())
+
+    @property
+    def memoryBudget(self):
+        """the maximum number of bytes of pixel data held in memory, no
+        limit when None"""
+        return self._memoryBudget
+    @memoryBudget.setter
+    def memoryBudget(self,budget):
+        self._memoryBudget = budget
+        self._enforceBudget()
+
+    def _recount(self):
+        """recompute the number of bytes held in memory and the first
+        spectrum that has not been spilled, the lock must be held"""
+        self._nbytes = 0
+        self._firstUnspilled = len(self._data)
+        for i,s in enumerate(self._data):
+            n = s.nbytes
+            if n > 0 and i < self._firstUnspilled:
+                self._firstUnspilled = i
+            self._nbytes += n
+
+    def _updateBudget(self):
+        """recount the bytes held, eg after representations of the spectra 
+        have been cached, and enforce the memory budget"""
+        if self._memoryBudget is None:
+            return
+        with self._lock:
+            self._recount()
+        self._enforceBudget()
+
+    def _enforceBudget(self):
+        """spill the pixels of the oldest spectra until the memory budget
+        is met
+
+        The spectra before _firstUnspilled have been spilled already, so
+        only the newly added spectra are visited."""
+        if self._memoryBudget is None:
+            return
+        with self._lock:
+            i = self._firstUnspilled
+            while self._nbytes > self._memoryBudget and i < len(self._data):
+                s = self._data[i]
+                n = s.nbytes
+                if n > 0:
+                    if self._spillFile is None:
+                        self._spillFile = PiccoloSpillFile()
+                    s.spill(self._spillFile)
+                    self._nbytes -= n-s.nbytes
+                    self._block = None
+                i += 1
+            self._firstUnspilled = i
 
     def _initFromData(self,data):
-        self._spectra = []
+        with self._lock:
+            for t,buf in self._buffers:
+                buf.clear()
+            self._data = []
+            self._frozen = None
+            self._pending = 0
+            self._nbytes = 0
+            self._firstUnspilled = 0
         if isinstance(data,(str,unicode)):
             data = json.loads(data)
 
@@ -91,21 +322,31 @@ class PiccoloSpectraList(MutableSequence):
         """
         old_chunks = self._NCHUNKS
         self._NCHUNKS = 1
+        if 'S' in data:
+            self._seqNr = data['S']
         meta = decompressMetadata(data['M'])
         for i,_ in enumerate(meta):
-            pixels = decompress8to16(data['P'][i])
-            meta[i]['Pixels'] = pixels
+            p = data['P'][i]
+            if p.startswith(_LOSSLESS_MAGIC):
+                dtype,p = p[len(_LOSSLESS_MAGIC):].split(_LOSSLESS_MAGIC,1)
+                meta[i]['Pixels'] = decompressArray(p,dtype=str(dtype))
+            else:
+                pixels = decompress8to16(p)
+                # the pixels are counts, round to avoid truncation when the
+                # values are converted to integers
+                meta[i]['Pixels'] = numpy.rint(pixels)
             if data['D'][i] == 'T':
                 #array was diff-compressed, need to re-sum it
                 wlen_idxs = decompressArray(data['W'][i],dtype='uint8')
-                wavelengths = numpy.empty(wlen_idxs.size + 1)
+                wavelengths = numpy.empty(wlen_idxs.size + 1,dtype=numpy.int64)
                 wavelengths[1:] = numpy.cumsum(wlen_idxs)
                 wavelengths[0] = 0
             else:
-                wavelengths = decompressArray(data['W'])
+                wavelengths = decompressArray(data['W'][i])
 
-            meta[i]['Metadata']['Wavelengths'] = wavelengths
-            meta[i]['Metadata']['FileName'] = data.get('F','')
+            meta[i]['Metadata']['Wavelengths'] = wavelengths.tolist()
+            if 'F' in data:
+                meta[i]['Metadata']['FileName'] = data['F']
             self.append(PiccoloSpectrum(data=meta[i]))
 
         self._NCHUNKS = old_chunks
@@ -152,24 +393,74 @@ class PiccoloSpectraList(MutableSequence):
     def directions(self):
         """a set containing all directions present in the spectra list"""
         dirs = set()
-        for s in self._spectra:
+        for s in self._items():
             dirs.add(s['Direction'])
         return list(dirs)
 
     @property
     def haveDark(self):
-        for s in self._spectra:
+        for s in self._items():
             if s['Dark']:
                 return True
         return False
 
     @property
     def haveLight(self):
-        for s in self._spectra:
+        for s in self._items():
             if not s['Dark']:
                 return True
         return False
 
+    def _saturation(self):
+        """compute number of saturated pixels for all spectra
+
+        The results are cached and recomputed when a spectrum is modified.
+        Spectra without a SaturationLevel are never saturated."""
+        spectra = self._items()
+        versions = [s.version for s in spectra]
+        if self._saturationCache is not None:
+            cSpectra,cVersions,result = self._saturationCache
+            if cVersions == versions and len(cSpectra) == len(spectra) and \
+               all(a is b for a,b in zip(cSpectra,spectra)):
+                return result
+
+        n = len(spectra)
+        counts = numpy.zeros(n,dtype=numpy.int64)
+        sizes = numpy.zeros(n,dtype=numpy.int64)
+        # group spectra by number of pixels so each group can be stacked
+        groups = {}
+        for i,s in enumerate(spectra):
+            groups.setdefault(s.getNumberOfPixels(),[]).append(i)
+        for nPixels,idx in groups.iteritems():
+            pixels = numpy.vstack([spectra[i].pixels for i in idx])
+            levels = numpy.array(
+                [spectra[i].get('SaturationLevel',numpy.inf) 
+                 for i in idx],dtype=numpy.float64)
+            counts[idx] = numpy.count_nonzero(pixels>=levels[:,None],axis=1)
+            sizes[idx] = nPixels
+
+        result = (counts,sizes)
+        self._saturationCache = (spectra,versions,result)
+        return result
+
+    def saturatedPixels(self):
+        """the number of saturated pixels of each spectrum
+        :return: array of counts, one per spectrum"""
+        return self._saturation()[0].copy()
+
+    def saturatedFraction(self):
+        """the fraction of saturated pixels of each spectrum
+        :return: array of fractions, one per spectrum"""
+        counts,sizes = self._saturation()
+        return counts/numpy.maximum(sizes,1).astype(numpy.float64)
+
+    def isSaturated(self,threshold=0):
+        """flag saturated spectra
+        :param threshold: a spectrum is flagged when the fraction of 
+                          saturated pixels exceeds the threshold
+        :return: boolean array, one per spectrum"""
+        return self.saturatedFraction() > threshold
+
     def haveSpectrum(self,spectrum):
         """check if a particular spectrum type is available
         :param spectrum: must be either Light or Dark"""
@@ -192,17 +483,148 @@ class PiccoloSpectraList(MutableSequence):
         else:
             raise KeyError, 'spectrum must be one of Dark or Light'
         spectra = []
-        for s in self._spectra:
+        for s in self._items():
             if s['Direction'] == direction and s['Dark'] == dark:
                  spectra.append(s)
         return spectra
 
-    def serialize(self,pretty=True,pixelType='list',spectrum=None):
+    def _isConsolidated(self,spectra):
+        """check if the pixels of all spectra are rows of the pixel block"""
+        block = self._block() if self._block is not None else None
+        if block is None or len(block) != len(spectra):
+            return False
+        for i,s in enumerate(spectra):
+            p = s._pixels
+            if p is None or p.shape != block[i].shape or p.dtype != block.dtype \
+               or p.ctypes.data != block[i].ctypes.data:
+                return False
+        return True
+
+    def as_array(self,consolidate=True):
+        """represent spectra list as a 2D pixel array and metadata columns
+
+        :param consolidate: when set to True (default) the pixels of each 
+                            spectrum are replaced by a view of the 
+                            corresponding row of the returned array so that
+                            subsequent exports do not copy the pixels. The
+                            returned array is then read-only.
+                            Spilled spectra and spectra whose dtype differs
+                            from the dtype of the array are not 
+                            consolidated. The list only keeps a weak 
+                            reference to the array so that it is freed once
+                            the rows are spilled or replaced.
+        :return: tuple of pixel array of shape (nSpectra,nPixels) and a 
+                 dictionary mapping metadata keys to lists of values (None
+                 where the key is missing)"""
+        spectra = self._items()
+        if self._isConsolidated(spectra):
+            block = self._block()
+        else:
+            self._block = None
+            if len(set(s.getNumberOfPixels() for s in spectra)) > 1:
+                raise RuntimeError, 'spectra have different numbers of pixels'
+            if len(spectra) > 0:
+                block = numpy.vstack([s.pixels for s in spectra])
+            else:
+                block = numpy.empty((0,0),dtype=PiccoloSpectrum.PIXEL_DTYPE)
+            if consolidate and not any(s.spilled for s in spectra) and \
+               all(s.dtype == block.dtype for s in spectra):
+                # the spectra must not be changed behind their back
+                block.flags.writeable = False
+                for i,s in enumerate(spectra):
+                    s._pixels = block[i]
+                    s._modified()
+                self._block = weakref.ref(block)
+
+        keys = set()
+        for s in spectra:
+            keys.update(s.keys())
+        columns = {}
+        for k in keys:
+            columns[k] = [s.get(k) for s in spectra]
+        return block,columns
+
+    @classmethod
+    def from_array(cls,pixels,metadata,seqNr=0,copy=True):
+        """create a spectra list from a 2D pixel array and metadata columns
+
+        The pixels of the spectra are read-only rows of a single array.
+
+        :param pixels: array of shape (nSpectra,nPixels)
+        :param metadata: dictionary mapping metadata keys to lists of values,
+                         None values are skipped
+        :param seqNr: the sequence number
+        :param copy: when set to False the spectra share memory with the 
+                     pixel array if the values do not need to be clipped;
+                     the pixel array must then not be modified"""
+        if copy:
+            pixels = numpy.array(pixels)
+        else:
+            pixels = numpy.asarray(pixels).view()
+        pixels.flags.writeable = False
+        assert pixels.ndim == 2
+        spectra = cls(seqNr=seqNr)
+        for i in range(pixels.shape[0]):
+            s = PiccoloSpectrum(dtype=pixels.dtype)
+            for k in metadata:
+                if metadata[k][i] is not None:
+                    s._meta[k] = metadata[k][i]
+            s.pixels = pixels[i]
+            spectra.append(s)
+        spectra._block = weakref.ref(pixels)
+        return spectra
+
+    def as_pandas(self):
+        """represent spectra list as a pandas DataFrame
+
+        The DataFrame contains one row per spectrum with a column per 
+        metadata key. The Pixels column holds views of the pixel array
+        returned by as_array."""
+        try:
+            import pandas
+        except ImportError:
+            raise RuntimeError, 'pandas is required for exporting to a DataFrame'
+        block,columns = self.as_array()
+        pix = numpy.empty(len(block),dtype=object)
+        for i in range(len(block)):
+            pix[i] = block[i]
+        columns['Pixels'] = pix
+        return pandas.DataFrame(columns)
+
+    def as_arrow(self):
+        """represent spectra list as a pyarrow Table
+
+        The Pixels column is a list array built on top of the pixel array 
+        returned by as_array. Metadata values which cannot be converted are
+        stored as JSON strings."""
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError, 'pyarrow is required for exporting to an arrow table'
+        block,columns = self.as_array()
+        names = sorted(columns.keys())
+        arrays = []
+        for k in names:
+            try:
+                arrays.append(pyarrow.array(columns[k]))
+            except (pyarrow.ArrowException,TypeError,ValueError):
+                arrays.append(pyarrow.array(
+                    [None if v is None else json.dumps(v) for v in columns[k]]))
+        offsets = numpy.arange(len(block)+1,dtype=numpy.int32)*block.shape[1]
+        arrays.append(pyarrow.ListArray.from_arrays(
+            pyarrow.array(offsets),pyarrow.array(block.reshape(-1))))
+        names.append('Pixels')
+        return pyarrow.Table.from_arrays(arrays,names=names)
+
+    def serialize(self,pretty=True,pixelType='list',spectrum=None,
+                  wavelengths=None):
         """serialize to JSON
 
         :param pretty: when set True (default) produce indented JSON
         :param pixelType: set the pixel type
-        :param spectrum: select spectrum type (Dark or Light) or both when None"""
+        :param spectrum: select spectrum type (Dark or Light) or both when None
+        :param wavelengths: only include pixels within a wavelength range
+                            (min,max) or list of ranges, all pixels when None"""
         if spectrum == 'Dark':
             dark = True
         elif spectrum == 'Light':
@@ -212,64 +634,146 @@ class PiccoloSpectraList(MutableSequence):
         else:
             raise KeyError, 'spectrum must be one of Dark or Light or None'
 
-        spectra = []
-        for s in self._spectra:
-            if dark is None:
-                spectra.append(s.as_dict(pixelType))
-            elif s['Dark'] == dark:
-                spectra.append(s.as_dict(pixelType))
-        root = {'Spectra':spectra, 'SequenceNumber': self._seqNr}
-
-        if pretty:
-            return json.dumps(root, sort_keys=True, indent=1)
-        else:
-            return json.dumps(root)
+        with span('PiccoloSpectraList.serialize') as sp:
+            spectra = []
+            with span('PiccoloSpectraList.serialize.fragments') as jsp:
+                for s in self._items():
+                    if dark is None or s['Dark'] == dark:
+                        spectra.append(s.serialize(pretty=pretty,
+                                                   pixelType=pixelType,
+                                                   wavelengths=wavelengths))
+                jsp.nbytes = sum(len(s) for s in spectra)
+
+            # assemble the cached fragments, the result is the same as
+            # dumping the entire dictionary
+            seqNr = json.dumps(self._seqNr)
+            if pretty:
+                if len(spectra) > 0:
+                    spectra = '[\n  {0}\n ]'.format(', \n  '.join(
+                        [f.replace('\n','\n  ') for f in spectra]))
+                else:
+                    spectra = '[]'
+                data = '{{\n "SequenceNumber": {0}, \n "Spectra": {1}\n}}'.format(seqNr,spectra)
+            else:
+                data = '{{"Spectra": [{0}], "SequenceNumber": {1}}}'.format(
+                    ', '.join(spectra),seqNr)
+            sp.nbytes = len(data)
+        # the cached fragments count towards the memory budget
+        self._updateBudget()
+        return data
 
-    def write(self,prefix='',clobber=True, split=True):
+    def write(self,prefix='',clobber=True, split=True, writer=None):
         """write spectra to file
 
         :param prefix: output prefix
         :param clobber: boolean whether files should be overwritten or not
-        :param split: when set to True split files into light and dark spectra"""
+        :param split: when set to True split files into light and dark spectra
+        :param writer: write the files durably in the background using a
+                       PiccoloFileWriter, write them synchronously when None
+        :return: list of PiccoloFuture objects, one per file, when a writer
+                 is used"""
 
         outName = os.path.join(prefix,self.outName)
         outDir = os.path.dirname(outName)
 
-        if not os.path.exists(outDir):
+        if writer is None and not os.path.exists(outDir):
             os.makedirs(outDir)
 
+        # work on a snapshot so that spectra appended while writing do not
+        # end up in only some of the files
+        spectra = self.snapshot()
+        files = []
         if split:
             for s in ['Dark','Light']:
-                if self.haveSpectrum(s):
-                    o = '%s.%s'%(outName,s.lower())
-                    if not clobber and os.path.exists(o):
-                        raise RuntimeError, '{} already exists'.format(o)
-                    with open(o,'w') as outf:
-                        outf.write(self.serialize(spectrum=s))
+                if spectra.haveSpectrum(s):
+                    files.append(('%s.%s'%(outName,s.lower()),s))
         else:
-            if not clobber and os.path.exists(outName):
-                raise RuntimeError, '{} already exists'.format(outName)
-            with open(outName,'w') as outf:
-                outf.write(self.serialize())
-
-    def getChunk(self,idx):
+            files.append((outName,None))
+
+        futures = []
+        for o,s in files:
+            if not clobber and os.path.exists(o):
+                raise RuntimeError, '{} already exists'.format(o)
+            data = spectra.serialize(spectrum=s)
+            if writer is not None:
+                futures.append(writer.submit(o,data))
+                continue
+            with span('PiccoloSpectraList.write',len(data)):
+                with open(o,'w') as outf:
+                    outf.write(data)
+        # the snapshot has cached the JSON fragments of the shared spectra
+        self._updateBudget()
+        if writer is not None:
+            return futures
+
+    def getChunk(self,idx,wavelengths=None):
         """get a particular chunk
         :param idx: the chunk index
+        :param wavelengths: only include pixels within a wavelength range
+                            (min,max) or list of ranges, all pixels when None;
+                            the same ranges must be used for all chunks
         :return: JSON string containing the data"""
         assert isinstance(idx,int)
         assert idx>=0 and idx < self.NCHUNKS
 
-        if idx == 0:
-            # first chunk is special, copy all the meta data
-            data = self.serialize(pretty=False,pixelType='size')
-        else:
-            data = []
-            for s in self._spectra:
-                data.append(s.getChunk(idx-1,self.NCHUNKS-1).tolist())
-            data = json.dumps(data)
+        with span('PiccoloSpectraList.getChunk') as sp:
+            if idx == 0:
+                # first chunk is special, copy all the meta data
+                data = self.serialize(pretty=False,pixelType='size',
+                                      wavelengths=wavelengths)
+            else:
+                data = []
+                for s in self._items():
+                    data.append(s.getChunk(idx-1,self.NCHUNKS-1,
+                                           wavelengths=wavelengths).tolist())
+                with span('json.dumps') as jsp:
+                    data = json.dumps(data)
+                    jsp.nbytes = len(data)
+            sp.nbytes = len(data)
 
         return data
 
+    def compress(self,wavelengths=None,maxError=0.49):
+        """encode spectra list in the simplified format
+
+        The metadata, pixels and pixel indices are compressed. Only pixels
+        within the wavelength ranges are included, their indices are
+        transferred in the Wavelengths metadata. The pixels of spectra for
+        which the error bound cannot be met with 16 bit codes are stored 
+        losslessly.
+
+        :param wavelengths: only include pixels within a wavelength range
+                            (min,max) or list of ranges, all pixels when None
+        :param maxError: maximum absolute error of the pixel values, the
+                         default recovers integer counts exactly
+        :return: JSON string which can be used to initialise a spectra list"""
+        meta = []
+        pixels = []
+        indices = []
+        diff = []
+        for s in self._items():
+            sel,idx = s._selectPixels(wavelengths)
+            m = dict(s.items())
+            m.pop('Wavelengths',None)
+            meta.append({'Metadata':m})
+            values = s.pixels[sel]
+            try:
+                p = compressBlockScaled(values,maxError=maxError)
+            except RuntimeError:
+                p = '{0}{1}{0}{2}'.format(_LOSSLESS_MAGIC,values.dtype.str,
+                                          compressArray(values,
+                                                        dtype=values.dtype))
+            pixels.append(p)
+            # a diff needs at least two indices
+            if len(idx) > 1 and idx[0] == 0:
+                isDiff,w = compressAsDiff(idx)
+            else:
+                isDiff,w = False,compressArray(idx)
+            indices.append(w)
+            diff.append('T' if isDiff else 'F')
+        return json.dumps({'M':compressMetadata(meta),'P':pixels,
+                           'W':indices,'D':''.join(diff),'S':self._seqNr})
+
     def setChunk(self,idx,data):
         """add a particular chunk
         :param idx: the chunk index
@@ -283,25 +787,105 @@ class PiccoloSpectraList(MutableSequence):
         else:
             assert self._chunkID is not None
             data = json.loads(data)
-            assert len(data) == len(self._spectra)
+            spectra = self._items()
+            assert len(data) == len(spectra)
             for i in range(len(data)):
-                self._spectra[i].setChunk(idx-1,self.NCHUNKS-1,data[i])
+                spectra[i].setChunk(idx-1,self.NCHUNKS-1,data[i])
         self._chunkID = idx
 
 
+class PiccoloSpillFile(object):
+    """a temporary file holding spilled pixel arrays
+
+    The whole file is memory mapped once. When it needs to grow the file is
+    extended in chunks and mapped again; arrays loaded from an older map keep
+    that map alive. The file is removed when it is closed or garbage
+    collected."""
+
+    CHUNKSIZE = 16*1024*1024
+
+    def __init__(self,dir=None):
+        """:param dir: the directory in which the temporary file is created"""
+        self._file = tempfile.TemporaryFile(dir=dir)
+        self._lock = threading.Lock()
+        self._size = 0
+        self._capacity = 0
+        self._map = None
+
+    def _reserve(self,nbytes):
+        """make sure there is space for nbytes, the lock must be held"""
+        if self._size+nbytes <= self._capacity:
+            return
+        capacity = max(2*self._capacity,self._size+nbytes)
+        capacity = -(-capacity//self.CHUNKSIZE)*self.CHUNKSIZE
+        self._file.truncate(capacity)
+        self._map = mmap.mmap(self._file.fileno(),capacity)
+        self._capacity = capacity
+
+    def store(self,values):
+        """append an array to the file
+        :param values: the array to be stored
+        :return: the offset of the array in the file"""
+        values = numpy.ascontiguousarray(values)
+        with self._lock:
+            self._reserve(values.nbytes)
+            offset = self._size
+            self._size += values.nbytes
+            m = self._map
+        numpy.frombuffer(m,dtype=values.dtype,count=values.size,
+                         offset=offset)[:] = values.reshape(-1)
+        return offset
+
+    def load(self,offset,shape,dtype):
+        """get an array stored in the file
+        :param offset: the offset returned by store
+        :param shape: the shape of the array
+        :param dtype: the dtype of the array
+        :return: array backed by the memory map"""
+        count = int(numpy.prod(shape))
+        return numpy.frombuffer(self._map,dtype=dtype,count=count,
+                                offset=offset).reshape(shape)
+
+    @property
+    def nbytes(self):
+        """the number of bytes stored in the file"""
+        return self._size
+
+    def close(self):
+        """close the file"""
+        self._map = None
+        self._file.close()
+
 class PiccoloSpectrum(MutableMapping):
     """An object containing an optical spectrum.
 
     The PiccoloSpectrum object behaves like a python dictionary. It can be
-    initialised from a JSON string. It also supports chunking."""
-    def __init__(self,data=None):
-        """:param data: JSON string used to initialise object"""
+    initialised from a JSON string. It also supports chunking.
+
+    The pixel values are stored using the pixel dtype, by default a 64bit
+    integer. A compact dtype such as uint16 or uint32, matching the native
+    counts of the spectrometer, can be selected per spectrum or by changing
+    the class attribute PIXEL_DTYPE."""
+
+    PIXEL_DTYPE = numpy.int
+    PIXEL_CLIP = 200000
+
+    def __init__(self,data=None,dtype=None):
+        """:param data: JSON string used to initialise object
+           :param dtype: the dtype used for storing the pixels, use
+                         PIXEL_DTYPE when None"""
         self._meta = {}
         self._meta['Direction'] = 'Missing metadata'
         self._meta['Dark'] = 'Missing metadata'
         self._meta['Type'] = 'Missing metadata'
+        if dtype is None:
+            dtype = self.PIXEL_DTYPE
+        self._dtype = numpy.dtype(dtype)
         self._pixels = None
+        self._spill = None
         self._complete = False
+        self._version = 0
+        self._cache = {}
         self.setDatetime()
 
         # initialise from json if available
@@ -312,7 +896,8 @@ class PiccoloSpectrum(MutableMapping):
                 self._meta[key] = data['Metadata'][key]
             if isinstance(data['Pixels'],int):
                 # create a list of correct size
-                self._pixels = -numpy.ones(data['Pixels'],dtype=numpy.int)
+                self._pixels = numpy.empty(data['Pixels'],dtype=self.dtype)
+                self._pixels.fill(self._missingValue)
             else:
                 self.pixels = data['Pixels']
 
@@ -321,6 +906,45 @@ class PiccoloSpectrum(MutableMapping):
         """whether all chunks have been set"""
         return self._complete
 
+    @property
+    def version(self):
+        """counter that is incremented whenever the spectrum is modified
+
+        .. note::
+          modifying the pixel array in place, other than through setChunk,
+          is not tracked"""
+        return self._version
+
+    def _modified(self):
+        self._version += 1
+        self._cache = {}
+
+    def _cached(self,key,func,params=None):
+        """get a cached representation of the spectrum
+
+        Only one value is kept per representation, a value computed with
+        different parameters replaces the cached value.
+        :param key: the name of the representation
+        :param func: function computing the representation if it is not
+                     cached
+        :param params: the parameters the representation depends on, eg
+                       the wavelength ranges"""
+        cache = self._cache
+        entry = cache.get(key)
+        if entry is not None and entry[0] == params:
+            return entry[1]
+        value = func()
+        cache[key] = (params,value)
+        return value
+
+    def __getstate__(self):
+        # load spilled pixels, the spill file cannot be pickled
+        state = self.__dict__.copy()
+        if self._spill is not None:
+            state['_pixels'] = numpy.array(self.pixels)
+            state['_spill'] = None
+        return state
+
     def __getitem__(self,key):
         return self._meta[key]
 
@@ -328,11 +952,13 @@ class PiccoloSpectrum(MutableMapping):
         if key in protectedKeys:
             raise KeyError, 'field {0} is a protected key'.format(key)
         self._meta[key] = value
+        self._modified()
 
     def __delitem__(self,key):
         if key in protectedKeys:
             raise KeyError, 'field {0} is a protected key'.format(key)
         del self._meta[key]
+        self._modified()
 
     def __iter__(self):
         return iter(self._meta)
@@ -346,6 +972,7 @@ class PiccoloSpectrum(MutableMapping):
         :type value: bool"""
         if value is None:
             self._meta['Direction'] = 'Upwelling'
+            self._modified()
         else:
             assert isinstance(value,bool)
             if value:
@@ -356,6 +983,7 @@ class PiccoloSpectrum(MutableMapping):
     def setDownwelling(self):
         """set direction to downwelling"""
         self._meta['Direction'] = 'Downwelling'
+        self._modified()
 
     def setDark(self,value=None):
         """set spectrum to dark
@@ -371,11 +999,13 @@ class PiccoloSpectrum(MutableMapping):
                 self._meta['Type'] = 'dark'
             else:
                 self._meta['Type'] = 'light'
+        self._modified()
 
     def setLight(self):
         """set spectrum to light"""
         self._meta['Dark'] = False
         self._meta['Type'] = 'light'
+        self._modified()
 
     def setDatetime(self,dt=None):
         """set date and time when spectrum is recorded
@@ -389,19 +1019,107 @@ class PiccoloSpectrum(MutableMapping):
             ts = datetime.strptime(dt,'%Y-%m-%dT%H:%M:%S')
 
         self._meta['Datetime'] = '{}Z'.format(ts.isoformat())
+        self._modified()
 
     @property
     def pixels(self):
         """the pixels"""
-        if self._pixels is None:
+        pixels = self._pixels
+        if pixels is None and self._spill is not None:
+            spillFile,offset,shape,dtype = self._spill
+            pixels = spillFile.load(offset,shape,dtype)
+        if pixels is None:
             raise RuntimeError, 'The pixel values have not been set.'
-        if len(self._pixels) == 0:
+        if len(pixels) == 0:
             raise RuntimeError, 'There are no pixels in the spectrum.'
-        return self._pixels
+        return pixels
     @pixels.setter
     def pixels(self,values):
-        tmp = numpy.minimum(values,200000)
-        self._pixels = numpy.array(tmp,dtype=numpy.int)
+        self.setPixels(values)
+
+    @property
+    def dtype(self):
+        """the dtype used for storing the pixels"""
+        return self._dtype
+
+    @property
+    def _missingValue(self):
+        """value used for pixels that have not been received yet"""
+        if self.dtype.kind == 'u':
+            return numpy.iinfo(self.dtype).max
+        return -1
+
+    def setPixels(self,values,clipInPlace=False):
+        """set the pixel values
+
+        The values are clipped at PIXEL_CLIP (or the maximum of the pixel
+        dtype if that is smaller) to avoid overflows. Arrays and objects
+        supporting the buffer protocol (bytearray, array.array, memoryview)
+        are adopted without copying if they already have the pixel dtype
+        and no clipping is required.
+
+        :param values: the pixel values
+        :param clipInPlace: when set to True clip the values in place instead
+                            of creating a clipped copy; only used if values
+                            is a writeable array of the pixel dtype"""
+        if isinstance(values,array.array):
+            values = numpy.frombuffer(values,dtype=values.typecode)
+        elif isinstance(values,(bytearray,buffer)):
+            values = numpy.frombuffer(values,dtype=self.dtype)
+        elif isinstance(values,memoryview):
+            # numpy.frombuffer does not accept memoryviews in python 2,
+            # view untyped bytes as the pixel dtype like a buffer
+            values = numpy.asarray(values)
+            if values.dtype.itemsize == 1 and values.dtype != self.dtype:
+                values = values.reshape(-1).view(self.dtype)
+        else:
+            values = numpy.asarray(values)
+
+        if values.size > 0:
+            clip = self.PIXEL_CLIP
+            lower = None
+            if self.dtype.kind in 'iu':
+                clip = min(clip,numpy.iinfo(self.dtype).max)
+                if self.dtype.kind == 'u' and values.min() < 0:
+                    lower = 0
+            if lower is not None or values.max() > clip:
+                if clipInPlace and values.dtype == self.dtype \
+                        and values.flags.writeable:
+                    numpy.clip(values,lower,clip,out=values)
+                else:
+                    values = numpy.clip(values,lower,clip)
+
+        if values.dtype != self.dtype:
+            values = values.astype(self.dtype)
+        self._pixels = values
+        self._spill = None
+        self._modified()
+
+    @property
+    def nbytes(self):
+        """the number of bytes of pixel data and cached representations held
+        in memory"""
+        nbytes = sum(len(v) for p,v in self._cache.itervalues())
+        if self._pixels is not None:
+            nbytes += self._pixels.nbytes
+        return nbytes
+
+    @property
+    def spilled(self):
+        """whether the pixels have been spilled to disk"""
+        return self._spill is not None
+
+    def spill(self,spillFile):
+        """move the pixels to a memory mapped file
+        :param spillFile: the file holding the pixels
+        :type spillFile: PiccoloSpillFile"""
+        # cached representations would defeat the purpose of spilling
+        self._cache = {}
+        if self._pixels is None:
+            return
+        offset = spillFile.store(self._pixels)
+        self._spill = (spillFile,offset,self._pixels.shape,self._pixels.dtype)
+        self._pixels = None
 
     def getNumberOfPixels(self):
         """the number of pixels"""
@@ -434,9 +1152,45 @@ class PiccoloSpectrum(MutableMapping):
 
         return w
 
-    def as_dict(self,pixelType='array'):
+    def pixelWavelengths(self):
+        """the wavelengths of the pixels as an array
+
+        This is a vectorised version of waveLengths."""
+        if 'Wavelengths' in self._meta:
+            idxs = numpy.asarray(self._meta['Wavelengths'],dtype=numpy.float64)
+        else:
+            idxs = numpy.arange(self.getNumberOfPixels(),dtype=numpy.float64)
+        if 'WavelengthCalibrationCoefficients' in self._meta:
+            C = self['WavelengthCalibrationCoefficients']
+            return numpy.polyval(list(C)[::-1],idxs)
+        return idxs
+
+    def _selectPixels(self,wavelengths):
+        """find the pixels within wavelength ranges
+        :param wavelengths: a wavelength range (min,max) or list of ranges
+        :return: selection of pixels (a slice when all pixels are selected)
+                 and array of the detector indices of the selected pixels"""
+        if 'Wavelengths' in self._meta:
+            idxs = numpy.asarray(self._meta['Wavelengths'],dtype=numpy.int64)
+        else:
+            idxs = numpy.arange(self.getNumberOfPixels(),dtype=numpy.int64)
+        ranges = _wavelengthRanges(wavelengths)
+        if ranges is None:
+            return slice(None),idxs
+        w = self.pixelWavelengths()
+        mask = numpy.zeros(w.size,dtype=bool)
+        for wmin,wmax in ranges:
+            mask |= (w>=wmin) & (w<=wmax)
+        sel = numpy.flatnonzero(mask)
+        return sel,idxs[sel]
+
+    def as_dict(self,pixelType='array',wavelengths=None):
         """represent spectrum as a dictionary
         :param pixelType: how the pxiels are represented
+        :param wavelengths: only include pixels within a wavelength range
+                            (min,max) or list of ranges, all pixels when None.
+                            The indices of the selected pixels are stored in
+                            the Wavelengths metadata.
 
         .. note::
           the pixelType should be one of
@@ -445,30 +1199,54 @@ class PiccoloSpectrum(MutableMapping):
            * 'size': store the size of pixel array, useful for initialising chunked array"""
         spectrum = {}
         spectrum['Metadata'] = dict(self.items())
+        if wavelengths is None:
+            pixels = self.pixels
+        else:
+            sel,idxs = self._selectPixels(wavelengths)
+            pixels = self.pixels[sel]
+            spectrum['Metadata']['Wavelengths'] = idxs.tolist()
         if pixelType == 'size':
-            spectrum['Pixels'] = self.getNumberOfPixels()
+            spectrum['Pixels'] = len(pixels)
         elif pixelType == 'list':
-            spectrum['Pixels'] = self.pixels.tolist()
+            spectrum['Pixels'] = pixels.tolist()
         elif pixelType == 'array':
-            spectrum['Pixels'] = self.pixels
+            spectrum['Pixels'] = pixels
         else:
             raise RuntimeError, 'unknown pixel type %s'%pixelType
         return spectrum
 
-    def serialize(self,pretty=True):
+    def serialize(self,pretty=True,pixelType='list',wavelengths=None):
         """serialize to JSON string
-        :param pretty: pretty print JSON"""
-        spectrum = self.as_dict(pixelType='list')
-        if pretty:
-            return json.dumps(spectrum, sort_keys=True, indent=1)
-        else:
-            return json.dumps(spectrum)
 
-    def getChunk(self,idx,nChunks):
+        The JSON string is cached until the spectrum is modified or spilled,
+        only the most recent wavelength ranges are cached.
+        :param pretty: pretty print JSON
+        :param pixelType: the pixel type, should be either 'list' or 'size'
+        :param wavelengths: only include pixels within a wavelength range
+                            (min,max) or list of ranges, all pixels when None"""
+        ranges = _wavelengthRanges(wavelengths)
+        def dump():
+            spectrum = self.as_dict(pixelType=pixelType,wavelengths=ranges)
+            with span('json.dumps') as sp:
+                if pretty:
+                    data = json.dumps(spectrum, sort_keys=True, indent=1)
+                else:
+                    data = json.dumps(spectrum)
+                sp.nbytes = len(data)
+            return data
+        return self._cached(('json',pixelType,pretty),dump,params=ranges)
+
+    def getChunk(self,idx,nChunks,wavelengths=None):
         """get a chunk
         :param idx: the chunk index
-        :param nChunks: the total number of chunks"""
-        return self.pixels[range(idx,self.getNumberOfPixels(),nChunks)]
+        :param nChunks: the total number of chunks
+        :param wavelengths: only include pixels within a wavelength range
+                            (min,max) or list of ranges, all pixels when None"""
+        if wavelengths is None:
+            pixels = self.pixels
+        else:
+            pixels = self.pixels[self._selectPixels(wavelengths)[0]]
+        return pixels[range(idx,len(pixels),nChunks)]
 
     def setChunk(self,idx,nChunks,data):
         """set a chunk
@@ -482,7 +1260,14 @@ class PiccoloSpectrum(MutableMapping):
             self._complete = True
         rng = range(idx,self.getNumberOfPixels(),nChunks)
         assert len(rng) == len(data)
-        self._pixels[rng] = data
+        pixels = self.pixels
+        if not pixels.flags.writeable:
+            # eg a row of a consolidated array, take a private copy
+            pixels = numpy.array(pixels)
+            self._pixels = pixels
+            self._spill = None
+        pixels[rng] = data
+        self._modified()
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,190 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+bounded LRU cache of spectra lists loaded from file
+"""
+
+__all__ = ['PiccoloSpectraCache']
+
+from PiccoloSpectra import PiccoloSpectraList
+from collections import OrderedDict
+import os.path
+import threading
+
+class PiccoloSpectraCache(object):
+    """a bounded LRU cache of spectra lists loaded from file
+
+    Entries are keyed by the file path and its modification time so that an
+    entry is invalidated automatically when the file is rewritten. The
+    cache is limited by both the number of entries and the number of bytes
+    of pixel data and cached JSON held. Entries are measured again whenever
+    the cache is accessed since callers may serialize the cached lists.
+
+    .. note::
+      the cached spectra lists are shared between all callers and must not
+      be modified
+    """
+
+    MAX_ENTRIES = 64
+    MAX_BYTES = 256*1024*1024
+
+    def __init__(self,maxEntries=None,maxBytes=None):
+        """:param maxEntries: maximum number of cached spectra lists, use
+                              MAX_ENTRIES when None
+           :param maxBytes: maximum number of bytes of pixel data and cached
+                            JSON held, use MAX_BYTES when None"""
+        if maxEntries is None:
+            maxEntries = self.MAX_ENTRIES
+        if maxBytes is None:
+            maxBytes = self.MAX_BYTES
+        self._maxEntries = maxEntries
+        self._maxBytes = maxBytes
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def maxEntries(self):
+        """the maximum number of cached spectra lists"""
+        return self._maxEntries
+
+    @property
+    def maxBytes(self):
+        """the maximum number of bytes of pixel data and cached JSON held"""
+        return self._maxBytes
+
+    @property
+    def nbytes(self):
+        """the number of bytes of pixel data and cached JSON currently held"""
+        with self._lock:
+            self._remeasure()
+            return self._nbytes
+
+    @property
+    def hits(self):
+        """the number of requests served from the cache"""
+        return self._hits
+
+    @property
+    def misses(self):
+        """the number of requests that required reading a file"""
+        return self._misses
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """remove all entries"""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _remeasure(self):
+        """update the sizes of all entries, the spectra lists grow when the
+        callers serialize them; the lock is held by the caller"""
+        nbytes = 0
+        for path,(mtime,spectra,n) in self._entries.items():
+            n = spectra.nbytes
+            self._entries[path] = (mtime,spectra,n)
+            nbytes += n
+        self._nbytes = nbytes
+
+    def _evict(self):
+        # the lock is held by the caller
+        self._remeasure()
+        while self._entries and (len(self._entries) > self._maxEntries or
+                                 self._nbytes > self._maxBytes):
+            path,(mtime,spectra,nbytes) = self._entries.popitem(last=False)
+            self._nbytes -= nbytes
+
+    def load(self,path):
+        """load a spectra list from file
+        :param path: the name of the file
+        :return: the spectra list
+        :rtype: PiccoloSpectraList"""
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            entry = self._entries.pop(path,None)
+            if entry is not None:
+                if entry[0] == mtime:
+                    self._entries[path] = entry
+                    self._hits += 1
+                    self._evict()
+                    return entry[1]
+                # the file has been rewritten
+                self._nbytes -= entry[2]
+
+        # parse the file without holding the lock
+        with open(path,'r') as inf:
+            spectra = PiccoloSpectraList(data=inf.read())
+
+        with self._lock:
+            self._misses += 1
+            old = self._entries.pop(path,None)
+            if old is not None:
+                self._nbytes -= old[2]
+            nbytes = spectra.nbytes
+            self._entries[path] = (mtime,spectra,nbytes)
+            self._nbytes += nbytes
+            self._evict()
+        return spectra
+
+    def loadSequence(self,prefix,seqNr,spectrum=None,listPrefix=''):
+        """load a spectra list given the prefix and sequence number
+        :param prefix: the output prefix passed to PiccoloSpectraList.write
+        :param seqNr: the sequence number
+        :param spectrum: select spectrum type (Dark or Light) or both when None
+        :param listPrefix: the prefix of the spectra list, see
+                           PiccoloSpectraList.prefix
+
+        The file name is constructed in the same way as by
+        PiccoloSpectraList.write. When the spectra were split into light
+        and dark files each file is cached separately."""
+        if spectrum not in [None,'Dark','Light']:
+            raise KeyError, 'spectrum must be one of Dark or Light or None'
+        outName = os.path.join(prefix,
+                               '{0}{1:06d}.pico'.format(listPrefix,seqNr))
+
+        if spectrum is None:
+            if os.path.exists(outName):
+                return self.load(outName)
+            spectra = PiccoloSpectraList(seqNr=seqNr)
+            found = False
+            for s in ['Dark','Light']:
+                o = '%s.%s'%(outName,s.lower())
+                if os.path.exists(o):
+                    found = True
+                    spectra.extend(self.load(o))
+            if not found:
+                raise IOError, 'no spectra found for {0}'.format(outName)
+            return spectra
+
+        o = '%s.%s'%(outName,spectrum.lower())
+        if not os.path.exists(o):
+            if os.path.exists(outName):
+                dark = spectrum == 'Dark'
+                spectra = PiccoloSpectraList(seqNr=seqNr)
+                spectra.extend(s for s in self.load(outName) 
+                               if s['Dark'] == dark)
+                return spectra
+            raise IOError, 'no {0} spectra found for {1}'.format(
+                spectrum.lower(),outName)
+        return self.load(o)
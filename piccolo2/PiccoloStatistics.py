@@ -0,0 +1,220 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+streaming per pixel statistics over spectra
+"""
+
+__all__ = ['PiccoloPixelStatistics','PiccoloSpectraStatistics']
+
+import numpy
+
+class PiccoloPixelStatistics(object):
+    """per pixel count, mean, variance, minimum and maximum
+
+    The statistics are accumulated incrementally. Batches of spectra are
+    reduced with numpy and combined with the running state using the
+    parallel variant of Welford's algorithm (Chan et al.), so that partial
+    statistics can also be merged."""
+
+    def __init__(self,nPixels):
+        """:param nPixels: the number of pixels of the spectra"""
+        self._count = 0
+        self._mean = numpy.zeros(nPixels,dtype=numpy.float64)
+        self._m2 = numpy.zeros(nPixels,dtype=numpy.float64)
+        self._min = numpy.empty(nPixels,dtype=numpy.float64)
+        self._min.fill(numpy.inf)
+        self._max = numpy.empty(nPixels,dtype=numpy.float64)
+        self._max.fill(-numpy.inf)
+
+    @property
+    def nPixels(self):
+        """the number of pixels"""
+        return self._mean.size
+
+    @property
+    def count(self):
+        """the number of spectra"""
+        return self._count
+
+    @property
+    def mean(self):
+        """the per pixel mean"""
+        return self._mean
+
+    @property
+    def variance(self):
+        """the per pixel population variance"""
+        if self._count == 0:
+            return numpy.zeros(self.nPixels)
+        return self._m2/self._count
+
+    @property
+    def sampleVariance(self):
+        """the per pixel sample variance"""
+        if self._count < 2:
+            return numpy.zeros(self.nPixels)
+        return self._m2/(self._count-1)
+
+    @property
+    def std(self):
+        """the per pixel standard deviation"""
+        return numpy.sqrt(self.variance)
+
+    @property
+    def min(self):
+        """the per pixel minimum"""
+        return self._min
+
+    @property
+    def max(self):
+        """the per pixel maximum"""
+        return self._max
+
+    def _combine(self,count,mean,m2,vmin,vmax):
+        if count == 0:
+            return
+        total = self._count+count
+        delta = mean-self._mean
+        self._mean += delta*(float(count)/total)
+        self._m2 += m2 + delta**2*(float(self._count)*count/total)
+        self._count = total
+        numpy.minimum(self._min,vmin,out=self._min)
+        numpy.maximum(self._max,vmax,out=self._max)
+
+    def addBatch(self,pixels):
+        """add a batch of spectra
+        :param pixels: 2D array of shape (nSpectra,nPixels)"""
+        pixels = numpy.asarray(pixels,dtype=numpy.float64)
+        if pixels.ndim == 1:
+            pixels = pixels.reshape(1,-1)
+        if pixels.shape[1] != self.nPixels:
+            raise RuntimeError, 'expected {0} pixels, got {1}'.format(self.nPixels,pixels.shape[1])
+        if pixels.shape[0] == 0:
+            return
+        mean = pixels.mean(axis=0)
+        m2 = ((pixels-mean)**2).sum(axis=0)
+        self._combine(pixels.shape[0],mean,m2,
+                      pixels.min(axis=0),pixels.max(axis=0))
+
+    def merge(self,other):
+        """merge statistics accumulated elsewhere
+        :type other: PiccoloPixelStatistics"""
+        assert isinstance(other,PiccoloPixelStatistics)
+        if other.nPixels != self.nPixels:
+            raise RuntimeError, 'cannot merge statistics with different number of pixels'
+        self._combine(other._count,other._mean,other._m2,other._min,other._max)
+
+class PiccoloSpectraStatistics(object):
+    """per pixel statistics grouped by (SerialNumber, Direction, Dark)"""
+
+    BATCHSIZE = 256
+
+    def __init__(self):
+        self._groups = {}
+        self._pending = {}
+
+    @staticmethod
+    def key(spectrum):
+        """the group key of a spectrum"""
+        return (spectrum.get('SerialNumber'),spectrum['Direction'],
+                spectrum['Dark'])
+
+    def _flush(self,key):
+        pixels = self._pending.pop(key,[])
+        if len(pixels) == 0:
+            return
+        if key not in self._groups:
+            self._groups[key] = PiccoloPixelStatistics(len(pixels[0]))
+        self._groups[key].addBatch(numpy.vstack(pixels))
+
+    def _flushAll(self):
+        for key in self._pending.keys():
+            self._flush(key)
+
+    def add(self,spectrum):
+        """add a single spectrum
+        :type spectrum: PiccoloSpectrum"""
+        key = self.key(spectrum)
+        pending = self._pending.setdefault(key,[])
+        if len(pending) > 0 and len(pending[0]) != spectrum.getNumberOfPixels():
+            raise RuntimeError, 'number of pixels changed for {0}'.format(key)
+        pending.append(spectrum.pixels)
+        if len(pending) >= self.BATCHSIZE:
+            self._flush(key)
+
+    def update(self,spectra):
+        """add spectra
+        :param spectra: a PiccoloSpectraList or any iterable of spectra"""
+        for s in spectra:
+            self.add(s)
+        self._flushAll()
+
+    def merge(self,other):
+        """merge statistics accumulated elsewhere, eg for a different file
+        :type other: PiccoloSpectraStatistics"""
+        assert isinstance(other,PiccoloSpectraStatistics)
+        other._flushAll()
+        self._flushAll()
+        for key in other._groups:
+            if key in self._groups:
+                self._groups[key].merge(other._groups[key])
+            else:
+                stats = PiccoloPixelStatistics(other._groups[key].nPixels)
+                stats.merge(other._groups[key])
+                self._groups[key] = stats
+
+    def keys(self):
+        """the group keys"""
+        self._flushAll()
+        return self._groups.keys()
+
+    def __getitem__(self,key):
+        """get the statistics of a group
+        :param key: tuple of (SerialNumber, Direction, Dark)
+        :rtype: PiccoloPixelStatistics"""
+        self._flushAll()
+        return self._groups[key]
+
+    def __contains__(self,key):
+        return key in self._groups or key in self._pending
+
+    def __len__(self):
+        return len(self.keys())
+
+if __name__ == '__main__':
+    from PiccoloSpectra import PiccoloSpectrum
+
+    data = numpy.random.randint(100,2000,(1000,50))
+    s1 = PiccoloSpectraStatistics()
+    s2 = PiccoloSpectraStatistics()
+    for i in range(data.shape[0]):
+        s = PiccoloSpectrum()
+        s.setUpwelling()
+        s.setDark()
+        s.pixels = data[i]
+        if i < 300:
+            s1.add(s)
+        else:
+            s2.add(s)
+    s1.merge(s2)
+    stats = s1[(None,'Upwelling',True)]
+    assert stats.count == data.shape[0]
+    assert numpy.allclose(stats.mean,data.mean(axis=0))
+    assert numpy.allclose(stats.variance,data.var(axis=0))
+    assert (stats.min == data.min(axis=0)).all()
+    assert (stats.max == data.max(axis=0)).all()
@@ -0,0 +1,102 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+task queue with priorities and coalescing of tasks by key
+"""
+
+__all__ = ['PiccoloTaskQueue']
+
+from Queue import Queue
+import heapq
+import itertools
+
+class PiccoloTaskQueue(Queue):
+    """a task queue supporting priorities and coalescing of duplicate tasks
+
+    The queue can be used as the tasks queue of a PiccoloWorkerThread. Tasks
+    with a lower priority value are returned first, tasks with the same
+    priority are returned in the order they were added. When a task is put
+    with a key and a task with the same key is still pending, the new task
+    is dropped. If the new task has a higher priority the pending task is
+    promoted instead.
+
+    .. note::
+      a coalesced task is only executed once, so only one result is produced
+      for all coalesced requests
+    """
+
+    PRIORITY_CONTROL = 0
+    PRIORITY_STATUS = 5
+    PRIORITY_NORMAL = 10
+
+    def _init(self,maxsize):
+        self.queue = []
+        self._pending = {}
+        self._counter = itertools.count()
+        self._size = 0
+
+    def _qsize(self,len=len):
+        return self._size
+
+    def put(self,item,block=True,timeout=None,priority=None,key=None):
+        """put a task into the queue
+        :param item: the task
+        :param block: block until a free slot is available
+        :param timeout: time to wait when blocking
+        :param priority: the priority, lower values are returned first; use
+                         PRIORITY_NORMAL when None
+        :param key: when not None, tasks with the same key are coalesced"""
+        if priority is None:
+            priority = self.PRIORITY_NORMAL
+        Queue.put(self,(priority,key,item),block,timeout)
+
+    def put_nowait(self,item,priority=None,key=None):
+        """put a task into the queue without blocking"""
+        return self.put(item,False,priority=priority,key=key)
+
+    def _put(self,item):
+        # called with the mutex held
+        priority,key,task = item
+        if key is not None and key in self._pending:
+            entry = self._pending[key]
+            if priority < entry[0]:
+                # invalidate old entry and add new one with higher priority
+                entry[-1] = False
+                entry = [priority,next(self._counter),key,entry[3],True]
+                self._pending[key] = entry
+                heapq.heappush(self.queue,entry)
+            # the task was coalesced, Queue.put increments the number of
+            # unfinished tasks after this method returns
+            self.unfinished_tasks -= 1
+            return
+        entry = [priority,next(self._counter),key,task,True]
+        if key is not None:
+            self._pending[key] = entry
+        heapq.heappush(self.queue,entry)
+        self._size += 1
+
+    def _get(self):
+        # called with the mutex held, there is at least one valid entry
+        while True:
+            priority,count,key,task,valid = heapq.heappop(self.queue)
+            if valid:
+                break
+        if key is not None:
+            del self._pending[key]
+        self._size -= 1
+        return task
@@ -23,6 +23,7 @@ __all__ = ['PiccoloWorkerThread']
 
 import threading
 from Queue import Queue
+from PiccoloBroadcast import PiccoloBroadcast
 import logging
 
 class PiccoloWorkerThread(threading.Thread):
@@ -35,14 +36,17 @@ class PiccoloWorkerThread(threading.Thread):
         :param name: the name of the worker thread
         :param busy: a lock indicating whether the worker is busy or not
         :type busy: threading.Lock
-        :param tasks: a queue used to communicate tasks to the worker
+        :param tasks: a queue used to communicate tasks to the worker, use a
+                      PiccoloTaskQueue for prioritised and coalesced tasks
         :type tasks: Queue.Queue
-        :param results: a queue used to communicate results to the caller
-        :type results: Queue.Queue
+        :param results: a queue used to communicate results to the caller,
+                        use a PiccoloBroadcast to send results to several
+                        consumers
+        :type results: Queue.Queue or PiccoloBroadcast
         :param daemon: whether the worker should be run in daemon mode or not
         """
         assert isinstance(tasks,Queue)
-        assert isinstance(results,Queue)
+        assert isinstance(results,(Queue,PiccoloBroadcast))
 
         threading.Thread.__init__(self)
         self.name = name
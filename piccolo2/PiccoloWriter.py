@@ -0,0 +1,273 @@
+# Copyright 2014-2016 The Piccolo Team
+#
+# This file is part of piccolo2-common.
+#
+# piccolo2-common is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# piccolo2-common is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with piccolo2-common.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+durable background file writing
+"""
+
+__all__ = ['PiccoloFuture','PiccoloFileWriter']
+
+from PiccoloProfile import span
+from Queue import Queue, Empty
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+def _getUmask():
+    # the umask can only be read by setting it
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+class PiccoloFuture(object):
+    """the result of an asynchronous operation"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        """whether the operation has completed"""
+        return self._event.is_set()
+
+    def _finish(self,result,exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for cb in callbacks:
+            self._invoke(cb)
+
+    def _invoke(self,callback):
+        # a failing callback must not affect the thread completing the future
+        try:
+            callback(self)
+        except Exception:
+            logging.getLogger('piccolo.writer').exception(
+                'exception in done callback')
+
+    def set_result(self,result):
+        self._finish(result,None)
+
+    def set_exception(self,exception):
+        self._finish(None,exception)
+
+    def add_done_callback(self,callback):
+        """call callback with the future as argument once it is done"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._invoke(callback)
+
+    def exception(self,timeout=None):
+        """wait for the operation and return its exception or None"""
+        if not self._event.wait(timeout):
+            raise RuntimeError, 'timed out waiting for result'
+        return self._exception
+
+    def result(self,timeout=None):
+        """wait for the operation and return its result, raises the
+        exception of the operation if it failed"""
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+class PiccoloFileWriter(threading.Thread):
+    """write files durably in a background thread
+
+    Each file is written to a temporary file in the target directory which
+    is fsynced and atomically renamed to the target name, so a crash never
+    leaves a truncated file behind. Requests arriving within the flush
+    interval are handled as one batch: all temporary files are written
+    first, then they are all synced, then renamed and finally each
+    directory is synced once per batch.
+    """
+
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self,flushInterval=None,fsync=True,daemon=True):
+        """:param flushInterval: the maximum time in seconds requests are
+                                 collected before they are written, use
+                                 FLUSH_INTERVAL when None
+           :param fsync: whether files and directories should be synced
+           :param daemon: whether the thread should be run in daemon mode"""
+        threading.Thread.__init__(self)
+        self.name = 'PiccoloFileWriter'
+        self.daemon = daemon
+        if flushInterval is None:
+            flushInterval = self.FLUSH_INTERVAL
+        self._flushInterval = flushInterval
+        self._fsync = fsync
+        # mkstemp creates files with mode 0600, give the output files the
+        # mode they would get from open
+        self._mode = 0o666 & ~_getUmask()
+        self._requests = Queue()
+        self._closed = False
+        self._log = logging.getLogger('piccolo.writer')
+        self.start()
+
+    @property
+    def flushInterval(self):
+        """the maximum time requests are collected before being written"""
+        return self._flushInterval
+
+    def submit(self,fname,data):
+        """request a file to be written
+        :param fname: the name of the output file
+        :param data: the string to be written
+        :return: future whose result is the file name
+        :rtype: PiccoloFuture"""
+        if self._closed:
+            raise RuntimeError, 'writer is closed'
+        future = PiccoloFuture()
+        self._requests.put((fname,data,future))
+        return future
+
+    def close(self,wait=True):
+        """stop the writer after all pending requests have been written
+        :param wait: wait for the writer thread to finish"""
+        if not self._closed:
+            self._closed = True
+            self._requests.put(None)
+        if wait:
+            self.join()
+
+    def _collect(self):
+        """get a batch of requests
+        :return: list of requests and whether the writer should stop"""
+        request = self._requests.get()
+        if request is None:
+            return [],True
+        batch = [request]
+        deadline = time.time()+self._flushInterval
+        while True:
+            remaining = deadline-time.time()
+            try:
+                if remaining > 0:
+                    request = self._requests.get(timeout=remaining)
+                else:
+                    request = self._requests.get_nowait()
+            except Empty:
+                break
+            if request is None:
+                return batch,True
+            batch.append(request)
+        return batch,False
+
+    def _remove(self,name):
+        try:
+            os.unlink(name)
+        except OSError:
+            self._log.warning('failed to remove temporary file %s',name)
+
+    def _writeBatch(self,batch):
+        # write all temporary files
+        pending = []
+        for fname,data,future in batch:
+            tmpName = None
+            try:
+                outDir = os.path.dirname(os.path.abspath(fname))
+                if not os.path.exists(outDir):
+                    try:
+                        os.makedirs(outDir)
+                    except OSError:
+                        # directory created by another process
+                        if not os.path.isdir(outDir):
+                            raise
+                # keep the target suffix out of the end of the name so that
+                # temporary files are not mistaken for spectra files
+                fd,tmpName = tempfile.mkstemp(
+                    dir=outDir,prefix='.'+os.path.basename(fname)+'.',
+                    suffix='.tmp')
+                with os.fdopen(fd,'w') as outf:
+                    outf.write(data)
+                os.chmod(tmpName,self._mode)
+                pending.append((fname,tmpName,outDir,future))
+            except Exception as e:
+                if tmpName is not None:
+                    self._remove(tmpName)
+                future.set_exception(e)
+
+        # sync them in one go
+        if self._fsync:
+            synced = []
+            for fname,tmpName,outDir,future in pending:
+                try:
+                    fd = os.open(tmpName,os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                    synced.append((fname,tmpName,outDir,future))
+                except Exception as e:
+                    self._remove(tmpName)
+                    future.set_exception(e)
+            pending = synced
+
+        # move them into place
+        renamed = []
+        dirs = set()
+        for fname,tmpName,outDir,future in pending:
+            try:
+                os.rename(tmpName,fname)
+                dirs.add(outDir)
+                renamed.append((fname,future))
+            except Exception as e:
+                self._remove(tmpName)
+                future.set_exception(e)
+
+        # and sync each directory once
+        if self._fsync:
+            for d in dirs:
+                try:
+                    fd = os.open(d,os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    self._log.warning('failed to sync directory %s',d)
+
+        for fname,future in renamed:
+            future.set_result(fname)
+
+    def run(self):
+        while True:
+            batch,stop = self._collect()
+            if batch:
+                try:
+                    with span('PiccoloFileWriter.flush',
+                              sum(len(b[1]) for b in batch)):
+                        self._writeBatch(batch)
+                except Exception as e:
+                    # keep the writer alive and do not leave callers waiting
+                    self._log.exception('failed to write batch')
+                    for fname,data,future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+            if stop:
+                break
@@ -22,6 +22,11 @@ setup(
     version = "0.1",
     namespace_packages = ['piccolo2'],
     packages = find_packages(),
+    entry_points = {
+        'console_scripts': [
+            'piccolo2-convert = piccolo2.PiccoloConvert:main',
+        ],
+    },
 
     # metadata for upload to PyPI
     author = "Magnus Hagdorn, Alasdair MacArthur, Iain Robinson",